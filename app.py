@@ -1,23 +1,93 @@
-from flask import Flask, request, session
+from flask import Flask, request, Response, stream_with_context, abort, send_file, url_for, g
 from twilio.twiml.voice_response import VoiceResponse, Gather
 import os
 import json
+import time
+import atexit
+import hashlib
 from datetime import datetime
+from urllib.parse import urlencode
+from store import create_store
+from callstate import create_call_states
+from media import create_media_cache
+from jobs import create_job_queue
+from pins import create_pin_directory
+from ratelimit import TokenBucketLimiter
+from broadcast import create_broadcast_dialer
+from metrics import REGISTRY, SIZE_BUCKETS, STEP_BUCKETS
+import twiml
 # Force redeploy
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this')
 
-# In-memory storage (for production, use a database)
-pastor_message = {'url': None, 'timestamp': None}
-missionary_responses = []
+RESPONSES_PAGE_SIZE = 100
+RESPONSES_MAX_PAGE_SIZE = 1000
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL')
 
-@app.route('/')
-def index():
-    return 'Missionary IVR System Running!'
+store = create_store()
 
-@app.route('/voice', methods=['POST'])
-def voice():
+REQUEST_SECONDS = REGISTRY.histogram('ivr_request_duration_seconds', 'Time spent handling a request',
+                                     ('route', 'method'))
+REQUEST_BYTES = REGISTRY.histogram('ivr_request_size_bytes', 'Request body size', ('route',), SIZE_BUCKETS)
+RESPONSE_BYTES = REGISTRY.histogram('ivr_response_size_bytes', 'Response body size', ('route',), SIZE_BUCKETS)
+REQUESTS = REGISTRY.counter('ivr_requests_total', 'Requests handled', ('route', 'method', 'status'))
+REQUEST_ERRORS = REGISTRY.counter('ivr_request_errors_total', 'Requests that ended in a server error', ('route',))
+CALL_STEP_SECONDS = REGISTRY.histogram('ivr_call_step_seconds', 'Time a caller spent at each IVR step',
+                                       ('step',), STEP_BUCKETS)
+CALL_COMPLETIONS = REGISTRY.counter('ivr_call_completions_total', 'Calls that finished their flow', ('flow',))
+CALL_DROPOFFS = REGISTRY.counter('ivr_call_dropoffs_total', 'Calls that ended early, by the last step reached',
+                                 ('step',))
+
+jobs = create_job_queue()
+atexit.register(jobs.stop)
+# Recording downloads get their own thread so a slow fetch never holds up response writes. Twilio
+# often has not finished the recording when <Record action> fires, so failed fetches back off and
+# retry for about a minute before playback settles for the remote URL.
+media_jobs = create_job_queue('media', 'MEDIA_JOB', workers=1, batch_size=1, max_attempts=6, backoff=2.0)
+atexit.register(media_jobs.stop)
+
+def queue_response(call_sid, name_url, response_url, caller):
+    jobs.submit('save_response', {
+        'name_recording': name_url,
+        'response_recording': response_url,
+        'caller': caller,
+        'timestamp': datetime.now().isoformat(),
+    }, key='response:{}'.format(call_sid) if call_sid else None)
+
+def finalize_abandoned_call(state):
+    CALL_DROPOFFS.inc(state.get('step', 'unknown'))
+    # The caller hung up before /save-response; keep whatever they recorded
+    if state.get('response_recording'):
+        queue_response(state.get('call_sid'), state.get('name_recording'), state['response_recording'],
+                       state.get('caller', 'Unknown'))
+
+call_states = create_call_states(store, on_abandoned=finalize_abandoned_call)
+media_cache = create_media_cache()
+pin_directory = create_pin_directory()
+# Both buckets are charged only for failed lookups, so a PIN shared by many missionaries is never
+# throttled. The caller bucket is per process and keyed on a From number the caller can spoof, so
+# what actually bounds guessing is pin_failures: one budget of failed attempts for the deployment.
+caller_pin_failures = TokenBucketLimiter(int(os.environ.get('PIN_CALLER_BURST', 5)),
+                                         float(os.environ.get('PIN_CALLER_REFILL_SECONDS', 60)))
+pin_failures = store.token_buckets(int(os.environ.get('PIN_FAILURES_BURST', 20)),
+                                   float(os.environ.get('PIN_FAILURES_REFILL_SECONDS', 5)))
+PIN_FAILURES_KEY = 'pin-failures'
+broadcasts = store.broadcasts()
+dialer = create_broadcast_dialer(broadcasts)
+if dialer:
+    # Start now so a restarted worker resumes pending broadcasts without waiting for traffic; the
+    # request hook covers workers forked from a preloaded master, whose threads did not survive
+    dialer.ensure_started()
+    atexit.register(dialer.stop)
+
+    @app.before_request
+    def start_dialer():
+        dialer.ensure_started()
+
+# TwiML is built and serialized once at import; routes only return the bytes
+def build_voice():
     response = VoiceResponse()
     response.say("Welcome to the missionary message system.")
     
@@ -26,148 +96,410 @@ def voice():
     response.append(gather)
     
     response.say("We did not receive your PIN. Goodbye.")
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    return response
+
+def build_pastor_pin(name):
+    response = VoiceResponse()
+    response.say("Welcome {}. Please record today's message after the beep. Press pound when finished.".format(name))
+    response.record(
+        max_length=300,
+        finish_on_key='#',
+        action='/save-pastor-message',
+        recording_status_callback='/recording-status'
+    )
+    return response
+
+def build_missionary_pin(name):
+    response = VoiceResponse()
+    response.say("Welcome {}. Please state your name after the beep. You have 5 seconds.".format(name))
+    response.record(
+        max_length=5,
+        action='/play-pastor-message',
+        recording_status_callback='/recording-status'
+    )
+    return response
+
+def build_say(message):
+    response = VoiceResponse()
+    response.say(message)
+    return response
+
+def record_response(response):
+    response.say("Please record your response after the beep. You have up to 3 minutes. Press pound when finished.")
+    response.record(
+        max_length=180,
+        finish_on_key='#',
+        action='/handle-response-menu'
+    )
+    return response
+
+def build_play_pastor_message(url=None):
+    response = VoiceResponse()
+    response.say("Thank you. Please listen to Pastor Jason's message.")
+    
+    if url:
+        response.play(url)
+    else:
+        response.say("No message from Pastor Jason is available yet.")
+    
+    return record_response(response)
+
+def build_response_menu():
+    response = VoiceResponse()
+    
+    gather = Gather(num_digits=1, action='/process-menu-choice', timeout=10)
+    gather.say("To save your response and disconnect, press 1. To re-record your message, press 2. To hear your playback, press 3.")
+    response.append(gather)
+    
+    # Default: save and hang up
+    response.say("No option selected. Saving your response. Goodbye.")
+    response.redirect('/save-response')
+    return response
+
+def build_redirect(url):
+    response = VoiceResponse()
+    response.redirect(url)
+    return response
+
+def build_playback(url=None):
+    response = VoiceResponse()
+    response.say("Here is your recorded message.")
+    if url:
+        response.play(url)
+    response.redirect('/handle-response-menu')
+    return response
+
+VOICE_TWIML = twiml.render_static(build_voice())
+PIN_TEMPLATES = {
+    'pastor': twiml.Template(build_pastor_pin, 'name'),
+    'missionary': twiml.Template(build_missionary_pin, 'name'),
+}
+DEFAULT_PIN_NAMES = {'pastor': 'Pastor', 'missionary': 'missionary'}
+INVALID_PIN_TWIML = twiml.render_static(build_say("Invalid PIN. Goodbye."))
+TOO_MANY_PIN_ATTEMPTS_TWIML = twiml.render_static(build_say("Too many PIN attempts. Please try again later. Goodbye."))
+PASTOR_MESSAGE_SAVED_TWIML = twiml.render_static(
+    build_say("Thank you Pastor Jason. Your message has been saved. Goodbye.")
+)
+NO_PASTOR_MESSAGE_TWIML = twiml.render_static(build_play_pastor_message())
+PLAY_PASTOR_MESSAGE_TEMPLATE = twiml.Template(build_play_pastor_message, 'url')
+RESPONSE_MENU_TWIML = twiml.render_static(build_response_menu())
+SAVE_RESPONSE_REDIRECT_TWIML = twiml.render_static(build_redirect('/save-response'))
+RERECORD_TWIML = twiml.render_static(record_response(VoiceResponse()))
+EMPTY_PLAYBACK_TWIML = twiml.render_static(build_playback())
+PLAYBACK_TEMPLATE = twiml.Template(build_playback, 'url')
+INVALID_OPTION_TWIML = twiml.render_static(build_say("Invalid option. Goodbye."))
+RESPONSE_SAVED_TWIML = twiml.render_static(
+    build_say("Your response has been saved. Thank you and God bless. Goodbye.")
+)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if 'request_started' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route, request.method)
+    REQUESTS.inc(route, request.method, str(response.status_code))
+    if response.status_code >= 500:
+        REQUEST_ERRORS.inc(route)
+    REQUEST_BYTES.observe(request.content_length or 0, route)
+    if response.content_length is not None:
+        RESPONSE_BYTES.observe(response.content_length, route)
+    REGISTRY.maybe_flush()
+    return response
+
+def trace_step(step, **fields):
+    """Move the call to step, recording how long the caller spent at the previous one."""
+    now = time.time()
+    previous = call_states.update(request.values.get('CallSid'), step=step, step_at=now, **fields)
+    if previous.get('step_at'):
+        CALL_STEP_SECONDS.observe(now - previous['step_at'], previous['step'])
+    return previous
+
+def end_call(state, counter, outcome):
+    if state.get('step_at'):
+        CALL_STEP_SECONDS.observe(time.time() - state['step_at'], state['step'])
+    counter.inc(outcome)
+    call_states.finish(request.values.get('CallSid'))
+
+def caller_number():
+    # Broadcast calls are placed by us, so the missionary is the callee
+    if request.values.get('Direction', '').startswith('outbound'):
+        return request.values.get('To', 'Unknown')
+    return request.values.get('From', 'Unknown')
+
+def pastor_message_url(pastor_message):
+    if media_cache is None or media_cache.path(pastor_message.get('media_id')) is None:
+        return pastor_message['url']
+    path = url_for('media', media_id=pastor_message['media_id'])
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL.rstrip('/') + path
+    return request.url_root.rstrip('/') + path
+
+def save_pastor_messages(messages):
+    # Only the newest message in a batch is ever played. Both writes are keyed by the recording
+    # URL, so a retry after a failed broadcast neither repeats the message nor the calls.
+    message = messages[-1]
+    store.set_pastor_message(message['url'], timestamp=message['timestamp'])
+    PLAY_PASTOR_MESSAGE_TEMPLATE.invalidate()
+    if media_cache is not None and media_cache.allows(message['url']):
+        media_jobs.submit('cache_media', {'url': message['url']}, key='media:{}'.format(message['url']))
+    if dialer:
+        recipients = [entry._asdict() for entry in pin_directory.entries('missionary') if entry.phone]
+        broadcasts.create_broadcast(message['url'], recipients)
+
+def cache_pastor_media(messages):
+    # Errors reach the queue so it retries; until then Twilio plays the original recording
+    for message in messages:
+        store.set_pastor_media(message['url'], media_cache.fetch(message['url']))
+        PLAY_PASTOR_MESSAGE_TEMPLATE.invalidate()
+
+jobs.register('save_response', store.add_responses)
+jobs.register('pastor_message', save_pastor_messages)
+jobs.register('recording_status', store.save_recordings)
+media_jobs.register('cache_media', cache_pastor_media)
+
+@app.route('/')
+def index():
+    return 'Missionary IVR System Running!'
+
+@app.route('/voice', methods=['POST'])
+def voice():
+    trace_step('voice', caller=caller_number())
+    return VOICE_TWIML, 200, twiml.HEADERS
 
 @app.route('/handle-pin', methods=['POST'])
 def handle_pin():
     digits = request.form.get('Digits', '')
-    response = VoiceResponse()
+    caller = caller_number()
     
-    if digits == '888':
-        # Pastor flow
-        response.say("Welcome Pastor Jason. Please record today's message after the beep. Press pound when finished.")
-        response.record(
-            max_length=300,
-            finish_on_key='#',
-            action='/save-pastor-message',
-            recording_status_callback='/recording-status'
-        )
-    elif digits == '777':
-        # Missionary flow
-        response.say("Welcome missionary. Please state your name after the beep. You have 5 seconds.")
-        response.record(
-            max_length=5,
-            action='/play-pastor-message',
-            recording_status_callback='/recording-status'
-        )
-    else:
-        response.say("Invalid PIN. Goodbye.")
+    if not caller_pin_failures.allowed(caller) or not pin_failures.allowed(PIN_FAILURES_KEY):
+        end_call(call_states.get(request.form.get('CallSid')), CALL_DROPOFFS, 'pin-throttled')
+        return TOO_MANY_PIN_ATTEMPTS_TWIML, 200, twiml.HEADERS
     
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    entry = pin_directory.lookup(digits)
+    if entry is None:
+        caller_pin_failures.consume(caller)
+        pin_failures.consume(PIN_FAILURES_KEY)
+        end_call(call_states.get(request.form.get('CallSid')), CALL_DROPOFFS, 'invalid-pin')
+        return INVALID_PIN_TWIML, 200, twiml.HEADERS
+    
+    trace_step('handle-pin', role=entry.role, pin_name=entry.name, congregation=entry.congregation, caller=caller)
+    body = PIN_TEMPLATES[entry.role].render(name=entry.name or DEFAULT_PIN_NAMES[entry.role])
+    return body, 200, twiml.HEADERS
 
 @app.route('/save-pastor-message', methods=['POST'])
 def save_pastor_message():
-    global pastor_message
     recording_url = request.form.get('RecordingUrl')
     
     if recording_url:
         # Split URL at query string, insert .mp3 before it
         if '?' in recording_url:
             base_url, query_string = recording_url.split('?', 1)
-            pastor_message['url'] = base_url + '.mp3?' + query_string
+            mp3_url = base_url + '.mp3?' + query_string
         else:
-            pastor_message['url'] = recording_url + '.mp3'
-        pastor_message['timestamp'] = datetime.now().isoformat()
+            mp3_url = recording_url + '.mp3'
+        recording_sid = request.form.get('RecordingSid')
+        jobs.submit('pastor_message', {'url': mp3_url, 'timestamp': datetime.now().isoformat()},
+                    key='pastor:{}'.format(recording_sid) if recording_sid else None)
+    end_call(call_states.get(request.form.get('CallSid')), CALL_COMPLETIONS, 'pastor')
     
-    response = VoiceResponse()
-    response.say("Thank you Pastor Jason. Your message has been saved. Goodbye.")
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    return PASTOR_MESSAGE_SAVED_TWIML, 200, twiml.HEADERS
 
 @app.route('/play-pastor-message', methods=['POST'])
 def play_pastor_message():
     name_recording_url = request.form.get('RecordingUrl')
-    session['missionary_name_url'] = name_recording_url
-    
-    response = VoiceResponse()
-    response.say("Thank you. Please listen to Pastor Jason's message.")
+    trace_step('play-pastor-message', name_recording=name_recording_url, caller=caller_number())
     
+    pastor_message = store.get_pastor_message()
     if pastor_message['url']:
-        response.play(pastor_message['url'])
+        body = PLAY_PASTOR_MESSAGE_TEMPLATE.render(url=pastor_message_url(pastor_message))
     else:
-        response.say("No message from Pastor Jason is available yet.")
-    
-    response.say("Please record your response after the beep. You have up to 3 minutes. Press pound when finished.")
-    response.record(
-        max_length=180,
-        finish_on_key='#',
-        action='/handle-response-menu'
-    )
+        body = NO_PASTOR_MESSAGE_TWIML
     
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    return body, 200, twiml.HEADERS
 
 @app.route('/handle-response-menu', methods=['POST'])
 def handle_response_menu():
     recording_url = request.form.get('RecordingUrl')
-    session['response_url'] = recording_url
+    trace_step('handle-response-menu', response_recording=recording_url, caller=caller_number())
     
-    response = VoiceResponse()
-    
-    gather = Gather(num_digits=1, action='/process-menu-choice', timeout=10)
-    gather.say("To save your response and disconnect, press 1. To re-record your message, press 2. To hear your playback, press 3.")
-    response.append(gather)
-    
-    # Default: save and hang up
-    response.say("No option selected. Saving your response. Goodbye.")
-    response.redirect('/save-response')
-    
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    return RESPONSE_MENU_TWIML, 200, twiml.HEADERS
 
 @app.route('/process-menu-choice', methods=['POST'])
 def process_menu_choice():
     choice = request.form.get('Digits')
-    response = VoiceResponse()
+    state = trace_step('process-menu-choice')
     
     if choice == '1':
         # Save and disconnect
-        response.redirect('/save-response')
+        body = SAVE_RESPONSE_REDIRECT_TWIML
     elif choice == '2':
         # Re-record
-        response.say("Please record your response after the beep. You have up to 3 minutes. Press pound when finished.")
-        response.record(
-            max_length=180,
-            finish_on_key='#',
-            action='/handle-response-menu'
-        )
+        body = RERECORD_TWIML
     elif choice == '3':
         # Playback
-        response.say("Here is your recorded message.")
-        if session.get('response_url'):
-            response.play(session['response_url'])
-        response.redirect('/handle-response-menu')
+        response_url = state.get('response_recording')
+        if response_url:
+            body = PLAYBACK_TEMPLATE.render(url=response_url)
+        else:
+            body = EMPTY_PLAYBACK_TWIML
     else:
-        response.say("Invalid option. Goodbye.")
+        body = INVALID_OPTION_TWIML
     
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    return body, 200, twiml.HEADERS
 
 @app.route('/save-response', methods=['POST', 'GET'])
 def save_response():
-    response_url = session.get('response_url')
-    name_url = session.get('missionary_name_url')
+    call_sid = request.values.get('CallSid')
+    state = call_states.get(call_sid)
+    response_url = state.get('response_recording')
+    name_url = state.get('name_recording')
     
     if response_url:
-        missionary_responses.append({
-            'name_recording': name_url,
-            'response_recording': response_url,
-            'timestamp': datetime.now().isoformat(),
-            'caller': request.form.get('From', 'Unknown')
-        })
+        queue_response(call_sid, name_url, response_url, state.get('caller') or caller_number())
+    end_call(state, CALL_COMPLETIONS, 'missionary')
     
-    response = VoiceResponse()
-    response.say("Your response has been saved. Thank you and God bless. Goodbye.")
-    return str(response), 200, {'Content-Type': 'text/xml'}
+    return RESPONSE_SAVED_TWIML, 200, twiml.HEADERS
 
 @app.route('/recording-status', methods=['POST'])
 def recording_status():
-    # Handle recording status callbacks
+    recording_sid = request.form.get('RecordingSid')
+    if not recording_sid:
+        return '', 400
+    status = request.form.get('RecordingStatus')
+    jobs.submit('recording_status', {
+        'recording_sid': recording_sid,
+        'call_sid': request.form.get('CallSid'),
+        'status': status,
+        'url': request.form.get('RecordingUrl'),
+        'duration': request.form.get('RecordingDuration', type=int),
+        'updated_at': datetime.now().isoformat(),
+    }, key='recording:{}:{}'.format(recording_sid, status))
     return '', 200
 
+@app.route('/broadcast-status', methods=['POST'])
+def broadcast_status():
+    call_sid = request.form.get('CallSid')
+    if not call_sid:
+        return '', 400
+    broadcasts.update_recipient_status(call_sid, request.form.get('CallStatus'))
+    return '', 200
+
+@app.route('/broadcasts/<int:broadcast_id>', methods=['GET'])
+def view_broadcast(broadcast_id):
+    broadcast = broadcasts.get_broadcast(broadcast_id)
+    if broadcast is None:
+        abort(404)
+    return json.dumps(broadcast, indent=2), 200, {'Content-Type': 'application/json'}
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return REGISTRY.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/media/<media_id>.mp3', methods=['GET'])
+def media(media_id):
+    path = media_cache.path(media_id) if media_cache else None
+    if path is None:
+        abort(404)
+    # Content-addressed files never change, so ranges and caches can trust them forever
+    response = send_file(path, mimetype='audio/mpeg', conditional=True, etag=media_id, max_age=MEDIA_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+def parse_timestamp_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    # Normalise so string comparison in the store matches the stored isoformat
+    return datetime.fromisoformat(value).isoformat()
+
+def parse_int_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('{} must be an integer'.format(name))
+
+# Only ETags are offered: stored timestamps are naive local time with records landing several per
+# second, so Last-Modified could not tell two polls within the same second apart
+def not_modified(etag):
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+def conditional_headers(etag):
+    return {'ETag': '"{}"'.format(etag), 'Cache-Control': 'no-cache'}
+
+def iter_ndjson(limit, **filters):
+    # Walk the store a page at a time so memory stays flat however large the history is
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_size = RESPONSES_MAX_PAGE_SIZE if remaining is None else min(remaining, RESPONSES_MAX_PAGE_SIZE)
+        page = store.list_responses(limit=page_size, **filters)
+        for record in page:
+            yield json.dumps(record) + '\n'
+        if len(page) < page_size:
+            return
+        filters['after_id'] = page[-1]['id']
+        if remaining is not None:
+            remaining -= len(page)
+
 @app.route('/responses', methods=['GET'])
 def view_responses():
-    return json.dumps(missionary_responses, indent=2)
+    try:
+        filters = {
+            'caller': request.args.get('caller') or None,
+            'since': parse_timestamp_arg('since'),
+            'until': parse_timestamp_arg('until'),
+            'after_id': parse_int_arg('cursor'),
+        }
+        if filters['after_id'] is not None and filters['after_id'] < 0:
+            raise ValueError('cursor must not be negative')
+        limit = parse_int_arg('limit')
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+
+    wants_ndjson = request.args.get('format') == 'ndjson' or (
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    )
+    # Responses are append-only, so the newest id identifies the whole collection; the format is
+    # part of the tag because the same query string can be answered as JSON or NDJSON
+    latest = store.latest_response()
+    etag = hashlib.sha1('{}|{}|{}'.format(latest['id'] if latest else 0, request.query_string.decode(),
+                                          'ndjson' if wants_ndjson else 'json').encode()).hexdigest()
+    headers = conditional_headers(etag)
+    headers['Vary'] = 'Accept'
+    if not_modified(etag):
+        return '', 304, headers
+
+    if wants_ndjson:
+        return Response(stream_with_context(iter_ndjson(limit, **filters)),
+                        mimetype='application/x-ndjson', headers=headers)
+
+    limit = min(limit or RESPONSES_PAGE_SIZE, RESPONSES_MAX_PAGE_SIZE)
+    page = store.list_responses(limit=limit, **filters)
+    if len(page) == limit:
+        args = request.args.to_dict()
+        args['cursor'] = page[-1]['id']
+        headers['X-Next-Cursor'] = str(page[-1]['id'])
+        headers['Link'] = '<{}?{}>; rel="next"'.format(request.base_url, urlencode(args))
+    headers['Content-Type'] = 'application/json'
+    return json.dumps(page, indent=2), 200, headers
 
 @app.route('/pastor-message', methods=['GET'])
 def view_pastor_message():
-    return json.dumps(pastor_message, indent=2)
+    pastor_message = store.get_pastor_message()
+    etag = hashlib.sha1('{url}|{timestamp}|{media_id}'.format(**pastor_message).encode()).hexdigest()
+    headers = conditional_headers(etag)
+    if not_modified(etag):
+        return '', 304, headers
+    headers['Content-Type'] = 'application/json'
+    return json.dumps(pastor_message, indent=2), 200, headers
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
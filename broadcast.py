@@ -0,0 +1,264 @@
+"""Outbound calls announcing a new pastor message, paced under a calls-per-second ceiling."""
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = 'broadcast-dialer'
+# Recipients still waiting for a call; a newer broadcast supersedes these
+UNDIALED_STATUSES = ('pending', 'dialing')
+
+
+class MemoryBroadcasts:
+    """Broadcasts held in this process; only its own dialer sees them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._broadcasts = []
+        self._recipients = []
+        self._leases = {}
+
+    def create_broadcast(self, message_url, recipients):
+        now = time.time()
+        with self._lock:
+            for broadcast in self._broadcasts:
+                if broadcast['message_url'] == message_url:
+                    return broadcast['id']
+            for recipient in self._recipients:
+                if recipient['status'] in UNDIALED_STATUSES:
+                    recipient.update(status='superseded', updated_at=now)
+            broadcast_id = len(self._broadcasts) + 1
+            self._broadcasts.append({'id': broadcast_id, 'message_url': message_url,
+                                     'created_at': datetime.now().isoformat()})
+            for recipient in recipients:
+                self._recipients.append({
+                    'id': len(self._recipients) + 1, 'broadcast_id': broadcast_id,
+                    'phone': recipient['phone'], 'name': recipient.get('name'),
+                    'congregation': recipient.get('congregation'), 'status': 'pending', 'attempts': 0,
+                    'call_sid': None, 'error': None, 'next_attempt_at': now, 'claimed_at': None, 'updated_at': now,
+                })
+            return broadcast_id
+
+    def has_due_recipients(self, now, stale_before):
+        with self._lock:
+            return any(self._due(recipient, now, stale_before) for recipient in self._recipients)
+
+    def _due(self, recipient, now, stale_before):
+        if recipient['status'] == 'dialing':
+            return recipient['claimed_at'] < stale_before
+        return recipient['status'] == 'pending' and recipient['next_attempt_at'] <= now
+
+    def claim_recipients(self, limit, now, stale_before):
+        """Mark up to limit due recipients as dialing, reclaiming ones stuck since stale_before."""
+        claimed = []
+        with self._lock:
+            for recipient in self._recipients:
+                if len(claimed) >= limit:
+                    break
+                if self._due(recipient, now, stale_before):
+                    recipient.update(status='dialing', claimed_at=now, updated_at=now)
+                    claimed.append(dict(recipient))
+        return claimed
+
+    def update_recipient(self, recipient_id, **fields):
+        with self._lock:
+            self._recipients[recipient_id - 1].update(fields, updated_at=time.time())
+
+    def update_recipient_status(self, call_sid, status):
+        with self._lock:
+            for recipient in self._recipients:
+                if recipient['call_sid'] == call_sid:
+                    recipient.update(status=status, updated_at=time.time())
+
+    def get_broadcast(self, broadcast_id):
+        if not 0 < broadcast_id <= len(self._broadcasts):
+            return None
+        broadcast = dict(self._broadcasts[broadcast_id - 1])
+        broadcast['recipients'] = [dict(r) for r in self._recipients if r['broadcast_id'] == broadcast_id]
+        return broadcast
+
+    def acquire_lease(self, name, owner, expires_at, now):
+        with self._lock:
+            holder, holder_expires_at = self._leases.get(name, (None, 0))
+            if holder not in (None, owner) and holder_expires_at >= now:
+                return False
+            self._leases[name] = (owner, expires_at)
+            return True
+
+
+class BroadcastDialer:
+    """Dials claimed recipients from the broadcast store.
+
+    Every worker process runs a dialer thread, but only the holder of the store lease dials, so
+    the ceiling applies to the whole deployment and a restarted process simply picks up where the
+    store says the broadcast stands.
+    """
+
+    def __init__(self, broadcasts, client, from_number, call_url, status_callback_url, calls_per_second=1.0,
+                 workers=4, max_attempts=4, backoff=5.0, max_backoff=300.0, poll_interval=2.0,
+                 lease_seconds=30.0, claim_timeout=120.0):
+        self.broadcasts = broadcasts
+        self.client = client
+        self.from_number = from_number
+        self.call_url = call_url
+        self.status_callback_url = status_callback_url
+        self.interval = 1.0 / calls_per_second
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        # A claim only waits for its pacing slot before dialing starts, so never call it stale sooner
+        self.claim_timeout = max(claim_timeout, workers * self.interval + 60)
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._pool = None
+        self._thread = None
+        self._idle = threading.Semaphore(workers)
+        self._pace_lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def ensure_started(self):
+        # Like the job queue, each forked gunicorn worker needs its own thread
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = '{}:{}:{}'.format(socket.gethostname(), self._pid, uuid.uuid4().hex[:8])
+            self._stopping.clear()
+            self._idle = threading.Semaphore(self.workers)
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast-dial')
+            self._thread = threading.Thread(target=self._run, name='broadcast-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        # Recipients still marked dialing are reclaimed by the next lease holder after claim_timeout
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def _acquire_idle_workers(self):
+        # Wait for one idle dialing thread, then take whichever others are idle too
+        if not self._idle.acquire(timeout=self.poll_interval):
+            return 0
+        idle = 1
+        while idle < self.workers and self._idle.acquire(blocking=False):
+            idle += 1
+        return idle
+
+    def _run(self):
+        while not self._stopping.is_set():
+            idle = self._acquire_idle_workers()
+            if not idle:
+                continue
+            try:
+                now = time.time()
+                stale_before = now - self.claim_timeout
+                batch = []
+                # A read first, so idle workers do not take the write lock to renew a lease for nothing
+                if (self.broadcasts.has_due_recipients(now, stale_before)
+                        and self.broadcasts.acquire_lease(LEASE_NAME, self.owner, now + self.lease_seconds, now)):
+                    # Claim no more than can start dialing now, so nothing sits claimed in a queue
+                    batch = self.broadcasts.claim_recipients(idle, now, stale_before)
+            except Exception:
+                logger.exception('Broadcast scheduler could not reach the store')
+                batch = []
+            for _ in range(idle - len(batch)):
+                self._idle.release()
+            for recipient in batch:
+                self._pool.submit(self._dial_and_release, recipient)
+            if not batch:
+                self._stopping.wait(self.poll_interval)
+
+    def _dial_and_release(self, recipient):
+        try:
+            self.dial(recipient)
+        except Exception:
+            logger.exception('Broadcast call to %s failed unexpectedly', recipient['phone'])
+        finally:
+            self._idle.release()
+
+    def _wait_for_slot(self):
+        """Block until this thread may place a call under the calls-per-second ceiling."""
+        with self._pace_lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def dial(self, recipient):
+        attempts = recipient['attempts'] + 1
+        self._wait_for_slot()
+        # Refresh the claim as the request goes out so a slow pacing wait never looks stale
+        self.broadcasts.update_recipient(recipient['id'], claimed_at=time.time())
+        try:
+            call = self.client.calls.create(
+                to=recipient['phone'],
+                from_=self.from_number,
+                url=self.call_url,
+                status_callback=self.status_callback_url,
+                status_callback_event=['initiated', 'ringing', 'answered', 'completed'],
+            )
+        except Exception as e:
+            retryable = not isinstance(e, TwilioRestException) or e.status == 429 or e.status >= 500
+            if retryable and attempts < self.max_attempts:
+                # Full jitter keeps retries from many recipients from arriving in lockstep
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempts - 1)))
+                self.broadcasts.update_recipient(recipient['id'], status='pending', attempts=attempts,
+                                            error=str(e), next_attempt_at=time.time() + delay)
+            else:
+                logger.error('Giving up on broadcast call to %s: %s', recipient['phone'], e)
+                self.broadcasts.update_recipient(recipient['id'], status='failed', attempts=attempts, error=str(e))
+            return
+        self.broadcasts.update_recipient(recipient['id'], status=call.status or 'queued', attempts=attempts,
+                                    call_sid=call.sid, error=None)
+
+
+def create_twilio_client(account_sid, auth_token):
+    # One pooled requests session is shared by every dialing thread
+    client = Client(account_sid, auth_token, http_client=TwilioHttpClient(pool_connections=True, timeout=15))
+    api_base_url = os.environ.get('TWILIO_API_BASE_URL')
+    if api_base_url:
+        client.api.base_url = api_base_url
+    return client
+
+
+def create_broadcast_dialer(broadcasts):
+    if os.environ.get('BROADCAST_ENABLED', '').lower() not in ('1', 'true', 'yes'):
+        return None
+    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
+    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+    from_number = os.environ.get('TWILIO_PHONE_NUMBER')
+    public_base_url = os.environ.get('PUBLIC_BASE_URL')
+    if not (account_sid and auth_token and from_number and public_base_url):
+        logger.error('BROADCAST_ENABLED needs TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, '
+                     'TWILIO_PHONE_NUMBER and PUBLIC_BASE_URL; broadcasts are off')
+        return None
+    public_base_url = public_base_url.rstrip('/')
+    return BroadcastDialer(
+        broadcasts,
+        create_twilio_client(account_sid, auth_token),
+        from_number,
+        call_url=public_base_url + '/play-pastor-message',
+        status_callback_url=public_base_url + '/broadcast-status',
+        calls_per_second=float(os.environ.get('BROADCAST_CALLS_PER_SECOND', 1)),
+        workers=int(os.environ.get('BROADCAST_WORKERS', 4)),
+        max_attempts=int(os.environ.get('BROADCAST_MAX_ATTEMPTS', 4)),
+    )
@@ -0,0 +1,95 @@
+"""Per-call IVR state keyed by Twilio's CallSid instead of a signed cookie session."""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCallStates:
+    """Bounded LRU with TTL; only visible to the worker that wrote it."""
+
+    def __init__(self, max_calls=10000):
+        self.max_calls = max_calls
+        self._lock = threading.Lock()
+        self._calls = OrderedDict()
+        self._evicted = []
+
+    def get(self, call_sid):
+        with self._lock:
+            entry = self._calls.get(call_sid)
+            if entry is None:
+                return None
+            self._calls.move_to_end(call_sid)
+            return dict(entry[1])
+
+    def put(self, call_sid, state, updated_at):
+        with self._lock:
+            self._calls[call_sid] = (updated_at, dict(state))
+            self._calls.move_to_end(call_sid)
+            while len(self._calls) > self.max_calls:
+                # Keep evicted calls around until the next sweep so they still get finalized
+                self._evicted.append(self._calls.popitem(last=False)[1][1])
+
+    def delete(self, call_sid):
+        with self._lock:
+            self._calls.pop(call_sid, None)
+
+    def pop_expired(self, before):
+        with self._lock:
+            expired, self._evicted = self._evicted, []
+            for call_sid, (updated_at, state) in list(self._calls.items()):
+                if updated_at < before:
+                    del self._calls[call_sid]
+                    expired.append(state)
+            return expired
+
+
+class CallStateStore:
+    def __init__(self, backend, ttl=3600, sweep_interval=60, on_abandoned=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.on_abandoned = on_abandoned
+        self._next_sweep = time.time() + sweep_interval
+
+    def get(self, call_sid):
+        if not call_sid:
+            return {}
+        return self.backend.get(call_sid) or {}
+
+    def update(self, call_sid, **fields):
+        """Merge fields into the call's state and return the state as it was before."""
+        if not call_sid:
+            return {}
+        now = time.time()
+        previous = self.get(call_sid)
+        state = dict(previous, call_sid=call_sid, **fields)
+        self.backend.put(call_sid, state, now)
+        if now >= self._next_sweep:
+            self.sweep(now)
+        return previous
+
+    def finish(self, call_sid):
+        if call_sid:
+            self.backend.delete(call_sid)
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        self._next_sweep = now + self.sweep_interval
+        abandoned = self.backend.pop_expired(now - self.ttl)
+        if self.on_abandoned:
+            for state in abandoned:
+                self.on_abandoned(state)
+        return len(abandoned)
+
+
+def create_call_states(store, on_abandoned=None):
+    ttl = int(os.environ.get('CALL_STATE_TTL', 3600))
+    backend = os.environ.get('CALL_STATE_BACKEND', 'store')
+    if backend == 'memory':
+        states = MemoryCallStates(int(os.environ.get('CALL_STATE_MAX_CALLS', 10000)))
+    elif backend == 'store':
+        states = store.call_states()
+    else:
+        raise ValueError('Unknown CALL_STATE_BACKEND: {}'.format(backend))
+    return CallStateStore(states, ttl=ttl, on_abandoned=on_abandoned)
@@ -0,0 +1,18 @@
+"""Gunicorn hooks keeping the shared METRICS_DIR consistent; gunicorn loads this file by default."""
+import os
+
+import metrics
+
+
+def on_starting(server):
+    # Snapshots from a previous run would otherwise be summed into this one's counters
+    directory = os.environ.get('METRICS_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        metrics.clear_directory(directory)
+
+
+def child_exit(server, worker):
+    directory = os.environ.get('METRICS_DIR')
+    if directory:
+        metrics.mark_process_dead(directory, worker.pid)
@@ -0,0 +1,199 @@
+"""In-process job queue so webhooks can hand work to a thread pool and return immediately."""
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_QUEUES = weakref.WeakSet()
+
+
+def _collect(field):
+    def collect():
+        values = {}
+        for job_queue in list(_QUEUES):
+            if job_queue._pid == os.getpid():
+                values[(job_queue.name,)] = job_queue.stats()[field]
+        return values
+    return collect
+
+
+JOBS = REGISTRY.counter('ivr_jobs_total', 'Jobs finished or skipped, by outcome', ('queue', 'kind', 'result'))
+JOB_QUEUE_DEPTH = REGISTRY.gauge('ivr_job_queue_depth', 'Jobs waiting for a worker', ('queue',),
+                                 collect=_collect('depth'))
+JOB_QUEUE_DELAYED = REGISTRY.gauge('ivr_job_queue_delayed', 'Failed jobs waiting to be retried', ('queue',),
+                                   collect=_collect('delayed'))
+JOB_QUEUE_LAG = REGISTRY.gauge('ivr_job_queue_lag_seconds', 'Age of the oldest job waiting in any worker',
+                               ('queue',), collect=_collect('lag_seconds'), aggregate='max')
+
+
+class Job:
+    __slots__ = ('kind', 'payload', 'key', 'enqueued_at', 'attempts')
+
+    def __init__(self, kind, payload, key=None):
+        self.kind = kind
+        self.payload = payload
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class JobQueue:
+    """Workers pull a job, drain up to batch_size more, and hand each kind its batch in one call.
+
+    A failing batch is retried with exponential backoff; after max_attempts its jobs are dropped
+    and logged. Jobs submitted with a key are ignored while a job with that key is pending or
+    after it succeeded recently; a dropped job forgets its key so a redelivery is accepted again.
+    """
+
+    def __init__(self, workers=2, batch_size=50, max_attempts=5, backoff=0.5, dedupe_size=10000, name='jobs'):
+        self.name = name
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.dedupe_size = dedupe_size
+        self._handlers = {}
+        self._queue = queue.Queue()
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._stopping = False
+        self._counts = {'processed': 0, 'failed': 0, 'retried': 0, 'duplicates': 0}
+        self._last_lag = 0.0
+        _QUEUES.add(self)
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def submit(self, kind, payload, key=None):
+        if key is not None:
+            with self._lock:
+                if key in self._seen:
+                    self._counts['duplicates'] += 1
+                    JOBS.inc(self.name, kind, 'duplicate')
+                    return False
+                self._seen[key] = True
+                if len(self._seen) > self.dedupe_size:
+                    self._seen.popitem(last=False)
+        job = Job(kind, payload, key)
+        if self.workers <= 0:
+            self._run([job])
+            return True
+        self._ensure_started()
+        self._queue.put(job)
+        return True
+
+    def _ensure_started(self):
+        # Threads do not survive gunicorn's fork, so each worker process starts its own pool
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._threads = [
+                threading.Thread(target=self._work, name='{}-worker-{}'.format(self.name, i), daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def _release_due_retries(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._delayed and (self._stopping or self._delayed[0][0] <= now):
+                self._queue.put(heapq.heappop(self._delayed)[2])
+
+    def _work(self):
+        while True:
+            self._release_due_retries()
+            try:
+                job = self._queue.get(timeout=0.2)
+            except queue.Empty:
+                if self._stopping and not self._delayed:
+                    return
+                continue
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._last_lag = time.monotonic() - job.enqueued_at
+            self._run(batch)
+
+    def _run(self, batch):
+        by_kind = OrderedDict()
+        for job in batch:
+            by_kind.setdefault(job.kind, []).append(job)
+        for kind, jobs in by_kind.items():
+            try:
+                self._handlers[kind]([job.payload for job in jobs])
+            except Exception:
+                logger.exception('Job batch %s failed (%d jobs)', kind, len(jobs))
+                self._retry(jobs)
+            else:
+                with self._lock:
+                    self._counts['processed'] += len(jobs)
+                JOBS.inc(self.name, kind, 'processed', amount=len(jobs))
+
+    def _retry(self, jobs):
+        with self._lock:
+            for job in jobs:
+                job.attempts += 1
+                if job.attempts >= self.max_attempts or self.workers <= 0:
+                    self._counts['failed'] += 1
+                    JOBS.inc(self.name, job.kind, 'failed')
+                    logger.error('Dropping %s job after %d attempts: %r', job.kind, job.attempts, job.payload)
+                    if job.key is not None:
+                        self._seen.pop(job.key, None)
+                    continue
+                self._counts['retried'] += 1
+                JOBS.inc(self.name, job.kind, 'retried')
+                due = time.monotonic() + self.backoff * 2 ** (job.attempts - 1)
+                heapq.heappush(self._delayed, (due, next(self._sequence), job))
+
+    def stats(self):
+        with self._queue.mutex:
+            oldest = self._queue.queue[0].enqueued_at if self._queue.queue else None
+            depth = len(self._queue.queue)
+        with self._lock:
+            stats = dict(self._counts)
+            stats['delayed'] = len(self._delayed)
+        stats['depth'] = depth
+        stats['lag_seconds'] = time.monotonic() - oldest if oldest is not None else 0.0
+        stats['last_lag_seconds'] = self._last_lag
+        stats['workers'] = self.workers
+        return stats
+
+    def stop(self, timeout=25):
+        """Flush queued and delayed jobs, giving the workers up to timeout seconds."""
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if self._queue.qsize() or self._delayed:
+            logger.error('Job queue stopped with %d jobs unflushed', self._queue.qsize() + len(self._delayed))
+
+
+def create_job_queue(name='jobs', env_prefix='JOB', workers=2, batch_size=50, max_attempts=5, backoff=0.5):
+    return JobQueue(
+        workers=int(os.environ.get(env_prefix + '_WORKERS', workers)),
+        batch_size=int(os.environ.get(env_prefix + '_BATCH_SIZE', batch_size)),
+        max_attempts=int(os.environ.get(env_prefix + '_MAX_ATTEMPTS', max_attempts)),
+        backoff=float(os.environ.get(env_prefix + '_BACKOFF', backoff)),
+        name=name,
+    )
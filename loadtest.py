@@ -0,0 +1,276 @@
+"""Replay complete IVR call flows against the app and report per-route latency and throughput.
+
+Examples:
+    python loadtest.py --calls 500 --concurrency 50                  # in-process Flask test client
+    python loadtest.py --url http://localhost:5000 --calls 500       # an already running server
+    python loadtest.py --gunicorn 1x1,2x4,4x8 --calls 2000 --concurrency 100
+"""
+import argparse
+import hashlib
+import http.cookiejar
+import http.server
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Each step names text its TwiML must contain: a 200 saying "Invalid PIN" is still a failed call
+PASTOR_FLOW = [
+    ('/voice', {}, '<Gather'),
+    ('/handle-pin', {'Digits': '888'}, '<Record'),
+    ('/save-pastor-message', {'RecordingUrl': '{media}/Recordings/{recording}', 'RecordingSid': '{recording}'},
+     'message has been saved'),
+]
+MISSIONARY_FLOW = [
+    ('/voice', {}, '<Gather'),
+    ('/handle-pin', {'Digits': '777'}, '<Record'),
+    ('/play-pastor-message', {'RecordingUrl': '{media}/Recordings/{recording}-name'}, '<Record'),
+    ('/handle-response-menu', {'RecordingUrl': '{media}/Recordings/{recording}-response'}, '<Gather'),
+    ('/process-menu-choice', {'Digits': '1'}, '<Redirect'),
+    ('/save-response', {}, 'response has been saved'),
+]
+
+
+class FakeRecordingHandler(http.server.BaseHTTPRequestHandler):
+    """Stands in for api.twilio.com so recording downloads stay on this machine.
+
+    Each recording path has its own bytes, as real recordings would, so the content-addressed
+    cache stores one file per recording; ?bytes=N sets the size.
+    """
+
+    default_size = 16384
+
+    @staticmethod
+    def recording(path, size=default_size):
+        seed = hashlib.sha256(path.encode()).digest()
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        size = int(urllib.parse.parse_qs(url.query).get('bytes', [self.default_size])[0])
+        body = self.recording(url.path, size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_media_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeRecordingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+class HttpClient:
+    """One per simulated call, so cookies behave as they would for a single Twilio call."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def post(self, path, form):
+        data = urllib.parse.urlencode(form).encode()
+        try:
+            with self.opener.open(self.base_url + path, data=data, timeout=30) as resp:
+                return resp.status, resp.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode('utf-8', 'replace')
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, form):
+        response = self.client.post(path, data=form)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.flows = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, route, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        routes = {}
+        for route, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            routes[route] = {
+                'requests': len(samples),
+                'errors': self.errors.get(route, 0),
+                'rps': len(samples) / elapsed,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p95_ms': percentile(samples, 95) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+            }
+        total = sum(route['requests'] for route in routes.values())
+        return {'elapsed_s': elapsed, 'flows': self.flows, 'flows_per_s': self.flows / elapsed,
+                'requests_per_s': total / elapsed, 'routes': routes}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+def run_flow(make_client, flow, media_url, results):
+    client = make_client()
+    call_sid = 'CA' + uuid.uuid4().hex
+    recording = 'RE' + uuid.uuid4().hex
+    caller = '+1555{:07d}'.format(random.randrange(10 ** 7))
+    for route, fields, expected in flow:
+        form = {'CallSid': call_sid, 'From': caller}
+        form.update({key: value.format(media=media_url, recording=recording) for key, value in fields.items()})
+        start = time.perf_counter()
+        status, body = client.post(route, form)
+        ok = status == 200 and expected in body
+        results.record(route, time.perf_counter() - start, ok)
+        if not ok:
+            # Later steps would only measure the error path, so the call ends here like a real hang-up
+            break
+    with results._lock:
+        results.flows += 1
+
+
+def run_load(make_client, media_url, calls, concurrency, pastor_ratio):
+    results = Results()
+    flows = [PASTOR_FLOW if random.random() < pastor_ratio else MISSIONARY_FLOW for _ in range(calls)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(run_flow, make_client, flow, media_url, results) for flow in flows]:
+            future.result()
+    results.finished = time.perf_counter()
+    return results.summary()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, env):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+         '--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/', timeout=1).read()
+            return proc, url
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError('gunicorn exited with status {}'.format(proc.returncode))
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start on {}'.format(url))
+
+
+def isolated_env(workdir):
+    # Always overridden: an inherited STORE_PATH would load-test (and fill) a real database
+    env = dict(os.environ)
+    env.update({
+        'STORE_PATH': os.path.join(workdir, 'loadtest.db'),
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'media-cache'),
+        'MEDIA_FETCH_HOSTS': '127.0.0.1',
+        'METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'BROADCAST_ENABLED': '',
+        # Every simulated call shares a handful of PINs, far past what the limiter allows a real caller
+        'PIN_CALLER_BURST': str(10 ** 9),
+        'PIN_FAILURES_BURST': str(10 ** 9),
+    })
+    return env
+
+
+def print_summary(label, summary):
+    print('\n{}: {} flows in {:.2f}s ({:.1f} flows/s, {:.1f} req/s)'.format(
+        label, summary['flows'], summary['elapsed_s'], summary['flows_per_s'], summary['requests_per_s']))
+    print('{:<24}{:>9}{:>8}{:>9}{:>10}{:>10}{:>10}'.format('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, stats in summary['routes'].items():
+        print('{:<24}{requests:>9}{errors:>8}{rps:>9.1f}{p50_ms:>10.2f}{p95_ms:>10.2f}{p99_ms:>10.2f}'.format(route, **stats))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='base URL of a running server')
+    target.add_argument('--gunicorn', help='comma-separated WORKERSxTHREADS configurations to start and compare')
+    parser.add_argument('--calls', type=int, default=200, help='number of call flows to replay')
+    parser.add_argument('--concurrency', type=int, default=20, help='simultaneous calls')
+    parser.add_argument('--pastor-ratio', type=float, default=0.05, help='fraction of calls that are pastor flows')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    media_server, media_url = start_fake_media_server()
+    workdir = tempfile.mkdtemp(prefix='ivr-loadtest-')
+    results = {}
+    try:
+        if args.url:
+            results[args.url] = run_load(lambda: HttpClient(args.url), media_url,
+                                         args.calls, args.concurrency, args.pastor_ratio)
+        elif args.gunicorn:
+            for config in args.gunicorn.split(','):
+                workers, threads = (int(n) for n in config.lower().split('x'))
+                # Each configuration gets a fresh database so earlier runs do not skew later ones
+                env = isolated_env(tempfile.mkdtemp(dir=workdir))
+                proc, url = start_gunicorn(workers, threads, env)
+                try:
+                    results['gunicorn {}'.format(config)] = run_load(
+                        lambda: HttpClient(url), media_url, args.calls, args.concurrency, args.pastor_ratio)
+                finally:
+                    proc.terminate()
+                    proc.wait()
+        else:
+            env = isolated_env(workdir)
+            # This process exits after workdir is removed, so its atexit metrics flush would fail
+            env['METRICS_DIR'] = ''
+            os.environ.update(env)
+            import app
+            results['in-process'] = run_load(lambda: TestClient(app.app), media_url,
+                                             args.calls, args.concurrency, args.pastor_ratio)
+            app.jobs.stop()
+            app.media_jobs.stop()
+    finally:
+        media_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for label, summary in results.items():
+        print_summary(label, summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Local, content-addressed cache of recordings so Twilio plays them from us instead of refetching."""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.request
+from base64 import b64encode
+from urllib.parse import urlsplit
+
+MEDIA_ID = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 64 * 1024
+# Refresh a file's mtime on access at most this often; mtime is the LRU clock
+TOUCH_INTERVAL = 60
+
+
+def http_fetcher(account_sid=None, auth_token=None, timeout=30):
+    """Return a fetcher that streams a URL, sending Twilio credentials only to Twilio hosts."""
+    authorization = None
+    if account_sid and auth_token:
+        authorization = 'Basic ' + b64encode('{}:{}'.format(account_sid, auth_token).encode()).decode()
+
+    def fetch(url):
+        req = urllib.request.Request(url)
+        host = urlsplit(url).hostname or ''
+        if authorization and (host == 'twilio.com' or host.endswith('.twilio.com')):
+            # Unredirected, so the credentials never follow Twilio's redirect to its storage host
+            req.add_unredirected_header('Authorization', authorization)
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            while True:
+                chunk = resp.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    return fetch
+
+
+def host_allowed(url, allowed_hosts):
+    """True if url's host is one of allowed_hosts or a subdomain of one."""
+    host = (urlsplit(url).hostname or '').lower()
+    return any(host == allowed or host.endswith('.' + allowed) for allowed in allowed_hosts)
+
+
+class MediaCache:
+    def __init__(self, directory, max_bytes, fetcher=None, allowed_hosts=None):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher or http_fetcher()
+        # None allows any host; the app always passes a list so webhooks cannot make us fetch anything
+        self.allowed_hosts = allowed_hosts
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, media_id):
+        return os.path.join(self.directory, media_id + '.mp3')
+
+    def allows(self, url):
+        return self.allowed_hosts is None or host_allowed(url, self.allowed_hosts)
+
+    def fetch(self, url):
+        """Download url into the cache and return its media id (the SHA-256 of its bytes)."""
+        if not self.allows(url):
+            raise ValueError('Refusing to fetch media from {}'.format(urlsplit(url).hostname))
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self.fetcher(url):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError('Recording is larger than the media cache')
+                    digest.update(chunk)
+                    f.write(chunk)
+            media_id = digest.hexdigest()
+            # Same content always lands on the same name, so concurrent downloads are harmless
+            os.replace(tmp_path, self._path(media_id))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict(keep=media_id)
+        return media_id
+
+    def path(self, media_id):
+        if not MEDIA_ID.match(media_id or ''):
+            return None
+        path = self._path(media_id)
+        try:
+            mtime = os.stat(path).st_mtime
+            if time.time() - mtime > TOUCH_INTERVAL:
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def evict(self, keep=None):
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith('.mp3'):
+                        continue
+                    stat = entry.stat()
+                    total += stat.st_size
+                    entries.append((stat.st_mtime, stat.st_size, entry.name))
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                if name == '{}.mp3'.format(keep):
+                    continue
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def create_media_cache(fetcher=None):
+    directory = os.environ.get('MEDIA_CACHE_DIR', 'media-cache')
+    if not directory:
+        return None
+    if fetcher is None:
+        fetcher = http_fetcher(os.environ.get('TWILIO_ACCOUNT_SID'), os.environ.get('TWILIO_AUTH_TOKEN'))
+    allowed_hosts = [host.strip().lower() for host in os.environ.get('MEDIA_FETCH_HOSTS', 'twilio.com').split(',')
+                     if host.strip()]
+    return MediaCache(directory, int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 500 * 1024 * 1024)), fetcher,
+                      allowed_hosts)
@@ -0,0 +1,247 @@
+"""Minimal Prometheus-format counters, gauges and histograms, cheap enough to leave on for every request."""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+STEP_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 180, 300, 600)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {'|'.join(key): value for key, value in self._values.items()}
+
+    def merge(self, totals, snapshot):
+        for key, value in snapshot.items():
+            totals[key] = totals.get(key, 0) + value
+
+    def render(self, totals):
+        for key, value in sorted(totals.items()):
+            yield '{}{} {}'.format(self.name, _labels(self.labels, key.split('|') if self.labels else []), value)
+
+
+class Gauge:
+    """A value read from collect() whenever a snapshot is taken, merged across workers by aggregate."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None, aggregate='sum'):
+        if aggregate not in ('sum', 'max'):
+            raise ValueError('Unknown gauge aggregate: {}'.format(aggregate))
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.aggregate = aggregate
+
+    def snapshot(self):
+        values = self.collect() if self.collect else {}
+        return {'|'.join(key): value for key, value in values.items()}
+
+    def merge(self, totals, snapshot):
+        for key, value in snapshot.items():
+            if key not in totals:
+                totals[key] = value
+            elif self.aggregate == 'max':
+                totals[key] = max(totals[key], value)
+            else:
+                totals[key] += value
+
+    render = Counter.render
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                # Per-bucket counts plus +Inf, then sum; cumulated only when rendering
+                entry = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {'|'.join(key): list(entry) for key, entry in self._values.items()}
+
+    def merge(self, totals, snapshot):
+        for key, entry in snapshot.items():
+            total = totals.setdefault(key, [0] * len(entry))
+            for i, value in enumerate(entry):
+                total[i] += value
+
+    def render(self, totals):
+        for key, entry in sorted(totals.items()):
+            label_values = key.split('|') if self.labels else []
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, _labels(self.labels + ('le',), label_values + [bound]),
+                                              cumulative)
+            yield '{}_sum{} {}'.format(self.name, _labels(self.labels, label_values), entry[-1])
+            yield '{}_count{} {}'.format(self.name, _labels(self.labels, label_values), cumulative)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry:
+    """Holds this process's metrics; with a shared directory, /metrics sums every gunicorn worker.
+
+    Like prometheus_client's multiprocess mode, the directory must be emptied before the server
+    starts (see clear_directory). Each process writes its own file, named by pid and a random
+    token so a reused pid never overwrites a dead worker's counters. Counters and histograms of
+    exited workers keep counting towards the totals; their gauges are dropped.
+    """
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = []
+        self._next_flush = 0
+        self._flush_lock = threading.Lock()
+        self._path_pid = None
+        self._path = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, labels=(), collect=None, aggregate='sum'):
+        metric = Gauge(name, help, labels, collect, aggregate)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def _snapshot_path(self):
+        # Forked workers inherit the parent's registry, so the path is chosen once per pid
+        if self._path_pid != os.getpid():
+            self._path_pid = os.getpid()
+            self._path = os.path.join(self.directory, '{}-{}.json'.format(self._path_pid, uuid.uuid4().hex[:8]))
+        return self._path
+
+    def maybe_flush(self):
+        if self.directory and time.monotonic() >= self._next_flush:
+            self.flush(blocking=False)
+
+    def flush(self, blocking=True):
+        """Write this process's snapshot; errors are logged so a full disk never fails a request."""
+        if not self.directory or not self._flush_lock.acquire(blocking=blocking):
+            return
+        try:
+            self._next_flush = time.monotonic() + self.flush_interval
+            snapshot = {metric.name: metric.snapshot() for metric in self._metrics}
+            path = self._snapshot_path()
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            logger.exception('Could not write metrics snapshot to %s', self.directory)
+        finally:
+            self._flush_lock.release()
+
+    def render(self):
+        snapshots = []
+        if self.directory:
+            own = self._snapshot_path()
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append((_snapshot_alive(path), json.load(f)))
+                except (OSError, ValueError):
+                    continue
+        snapshots.append((True, {metric.name: metric.snapshot() for metric in self._metrics}))
+        lines = []
+        for metric in self._metrics:
+            totals = {}
+            for alive, snapshot in snapshots:
+                if alive or metric.kind != 'gauge':
+                    metric.merge(totals, snapshot.get(metric.name, {}))
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.render(totals))
+        return '\n'.join(lines) + '\n'
+
+
+def _snapshot_alive(path):
+    name = os.path.basename(path)
+    if name.endswith('.dead.json'):
+        return False
+    try:
+        os.kill(int(name.split('-')[0]), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_directory(directory):
+    """Remove every snapshot; call once before any worker starts, e.g. from gunicorn's on_starting."""
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def mark_process_dead(directory, pid):
+    """Keep an exited worker's counters but stop reporting its gauges, e.g. from gunicorn's child_exit."""
+    for path in glob.glob(os.path.join(directory, '{}-*.json'.format(pid))):
+        if not path.endswith('.dead.json'):
+            try:
+                os.replace(path, path[:-len('.json')] + '.dead.json')
+            except FileNotFoundError:
+                pass
+
+
+REGISTRY = Registry(os.environ.get('METRICS_DIR') or None)
+# Without this a worker's last flush_interval of data would be lost when it exits
+atexit.register(REGISTRY.flush)
@@ -0,0 +1,95 @@
+"""PIN directory mapping callers' PINs to roles and congregations, reloaded when its file changes."""
+import csv
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+PinEntry = namedtuple('PinEntry', ['role', 'name', 'congregation', 'phone'])
+
+ROLES = ('pastor', 'missionary')
+# Used when no PIN_DIRECTORY file is configured, matching the original hardcoded PINs
+DEFAULT_ENTRIES = {
+    '888': PinEntry('pastor', 'Pastor Jason', None, None),
+    '777': PinEntry('missionary', None, None, None),
+}
+
+
+# Hashing only gives a uniform dict key; a three-digit PIN space is trivially reversed, so treat
+# pin_sha256 columns as being as sensitive as plaintext PINs
+def hash_pin(pin):
+    return hashlib.sha256(pin.encode()).hexdigest()
+
+
+def load_pin_file(path):
+    """Read a CSV with columns pin (or pin_sha256), role, name, congregation, phone."""
+    entries = {}
+    with open(path, newline='') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            role = (row.get('role') or '').strip().lower()
+            if role not in ROLES:
+                raise ValueError('{}:{}: unknown role {!r}'.format(path, line, role))
+            pin = (row.get('pin') or '').strip()
+            key = (row.get('pin_sha256') or '').strip().lower() or (hash_pin(pin) if pin else None)
+            if not key:
+                raise ValueError('{}:{}: missing pin'.format(path, line))
+            if key in entries:
+                raise ValueError('{}:{}: duplicate PIN'.format(path, line))
+            entries[key] = PinEntry(
+                role,
+                (row.get('name') or '').strip() or None,
+                (row.get('congregation') or '').strip() or None,
+                (row.get('phone') or '').strip() or None,
+            )
+    return entries
+
+
+class PinDirectory:
+    def __init__(self, path=None, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0
+        self._entries = {hash_pin(pin): entry for pin, entry in DEFAULT_ENTRIES.items()}
+        if path:
+            self._entries = load_pin_file(path)
+            self._signature = self._stat()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if not self.path or now < self._next_check or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            signature = self._stat()
+            if signature != self._signature:
+                # Build the new table completely, then swap one reference; readers never see a partial load
+                self._entries = load_pin_file(self.path)
+                self._signature = signature
+                logger.info('Reloaded %d PINs from %s', len(self._entries), self.path)
+        except (OSError, ValueError):
+            logger.exception('Keeping previous PIN directory; could not reload %s', self.path)
+        finally:
+            self._lock.release()
+
+    def lookup(self, pin):
+        self._maybe_reload()
+        return self._entries.get(hash_pin(pin))
+
+    def entries(self, role=None):
+        self._maybe_reload()
+        return [entry for entry in self._entries.values() if role is None or entry.role == role]
+
+
+def create_pin_directory():
+    return PinDirectory(os.environ.get('PIN_DIRECTORY') or None,
+                        int(os.environ.get('PIN_DIRECTORY_CHECK_INTERVAL', 5)))
@@ -0,0 +1,35 @@
+"""Token buckets keyed by caller or PIN, held in a bounded LRU per process (not shared between workers)."""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, burst, refill_seconds, max_keys=100000):
+        self.burst = burst
+        self.rate = 1.0 / refill_seconds
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allowed(self, key):
+        with self._lock:
+            if key not in self._buckets:
+                return True
+            return self._tokens(key, time.monotonic()) >= 1
+
+    def consume(self, key):
+        """Take a token and return whether one was available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
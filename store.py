@@ -0,0 +1,503 @@
+"""Response and pastor message storage shared by every gunicorn worker."""
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+from broadcast import MemoryBroadcasts, UNDIALED_STATUSES
+from callstate import MemoryCallStates
+from ratelimit import TokenBucketLimiter
+
+RESPONSE_FIELDS = ('id', 'name_recording', 'response_recording', 'timestamp', 'caller')
+RECIPIENT_FIELDS = ('id', 'broadcast_id', 'phone', 'name', 'congregation', 'status', 'attempts',
+                    'call_sid', 'error', 'next_attempt_at', 'claimed_at', 'updated_at')
+
+
+class ResponseStore(ABC):
+    @abstractmethod
+    def add_response(self, name_recording, response_recording, caller, timestamp=None):
+        pass
+
+    def add_responses(self, records):
+        for record in records:
+            self.add_response(record.get('name_recording'), record['response_recording'],
+                              record.get('caller'), record.get('timestamp'))
+
+    @abstractmethod
+    def list_responses(self, caller=None, since=None, until=None, after_id=None, limit=None):
+        pass
+
+    @abstractmethod
+    def latest_response(self):
+        pass
+
+    @abstractmethod
+    def set_pastor_message(self, url, timestamp=None, media_id=None):
+        """Make url the current message; saving the current one again changes nothing."""
+
+    @abstractmethod
+    def set_pastor_media(self, url, media_id):
+        pass
+
+    @abstractmethod
+    def get_pastor_message(self):
+        pass
+
+    @abstractmethod
+    def save_recordings(self, recordings):
+        pass
+
+    @abstractmethod
+    def call_states(self):
+        pass
+
+    @abstractmethod
+    def token_buckets(self, burst, refill_seconds):
+        """Token buckets with TokenBucketLimiter's interface, shared as widely as the store is."""
+
+    @abstractmethod
+    def broadcasts(self):
+        pass
+
+
+class MemoryStore(ResponseStore):
+    """Single-process store for local development; not shared between workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._responses = []
+        self._pastor_message = {'url': None, 'timestamp': None, 'media_id': None}
+        self._recordings = {}
+
+    def add_response(self, name_recording, response_recording, caller, timestamp=None):
+        with self._lock:
+            record = {
+                'id': len(self._responses) + 1,
+                'name_recording': name_recording,
+                'response_recording': response_recording,
+                'timestamp': timestamp or datetime.now().isoformat(),
+                'caller': caller,
+            }
+            self._responses.append(record)
+            return record['id']
+
+    def list_responses(self, caller=None, since=None, until=None, after_id=None, limit=None):
+        # Ids are 1-based positions, so a cursor can skip straight to its slice
+        start = after_id or 0
+        results = []
+        for record in self._responses[start:]:
+            if caller is not None and record['caller'] != caller:
+                continue
+            if since is not None and record['timestamp'] < since:
+                continue
+            if until is not None and record['timestamp'] >= until:
+                continue
+            results.append(dict(record))
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def latest_response(self):
+        if not self._responses:
+            return None
+        return dict(self._responses[-1])
+
+    def set_pastor_message(self, url, timestamp=None, media_id=None):
+        with self._lock:
+            if self._pastor_message.get('url') == url:
+                return
+            self._pastor_message = {
+                'url': url,
+                'timestamp': timestamp or datetime.now().isoformat(),
+                'media_id': media_id,
+            }
+
+    def set_pastor_media(self, url, media_id):
+        with self._lock:
+            if self._pastor_message.get('url') == url:
+                self._pastor_message['media_id'] = media_id
+
+    def get_pastor_message(self):
+        return dict(self._pastor_message)
+
+    def save_recordings(self, recordings):
+        with self._lock:
+            for recording in recordings:
+                self._recordings[recording['recording_sid']] = dict(recording)
+
+    def call_states(self):
+        return MemoryCallStates()
+
+    def token_buckets(self, burst, refill_seconds):
+        return TokenBucketLimiter(burst, refill_seconds)
+
+    def broadcasts(self):
+        return MemoryBroadcasts()
+
+
+class SQLiteStore(ResponseStore):
+    """SQLite in WAL mode: appends never block readers, and every worker sees the same file."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name_recording TEXT,
+            response_recording TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            caller TEXT
+        );
+        CREATE INDEX IF NOT EXISTS responses_caller_timestamp ON responses (caller, timestamp);
+        CREATE INDEX IF NOT EXISTS responses_timestamp ON responses (timestamp);
+        CREATE TABLE IF NOT EXISTS pastor_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            media_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS call_states (
+            call_sid TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS call_states_updated_at ON call_states (updated_at);
+        CREATE TABLE IF NOT EXISTS recordings (
+            recording_sid TEXT PRIMARY KEY,
+            call_sid TEXT,
+            status TEXT,
+            url TEXT,
+            duration INTEGER,
+            updated_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_url TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS broadcasts_message_url ON broadcasts (message_url);
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id),
+            phone TEXT NOT NULL,
+            name TEXT,
+            congregation TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            call_sid TEXT,
+            error TEXT,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS broadcast_recipients_status ON broadcast_recipients (status, next_attempt_at);
+        CREATE INDEX IF NOT EXISTS broadcast_recipients_broadcast ON broadcast_recipients (broadcast_id);
+        CREATE INDEX IF NOT EXISTS broadcast_recipients_call_sid ON broadcast_recipients (call_sid);
+        CREATE TABLE IF NOT EXISTS token_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._inherited = []
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        self._add_missing_columns(conn, 'pastor_messages', {'media_id': 'TEXT'})
+
+    def _add_missing_columns(self, conn, table, columns):
+        existing = {row['name'] for row in conn.execute('PRAGMA table_info({})'.format(table))}
+        for name, kind in columns.items():
+            if name not in existing:
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, kind))
+
+    def _connect(self):
+        # Connections are per thread and per process: a worker forked from a preloaded master
+        # inherits the master's thread-local connection, which SQLite forbids using after fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid != os.getpid():
+            # Never close it here either; keep it referenced so garbage collection does not
+            self._inherited.append(conn)
+            conn = None
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add_response(self, name_recording, response_recording, caller, timestamp=None):
+        cursor = self._connect().execute(
+            'INSERT INTO responses (name_recording, response_recording, timestamp, caller) VALUES (?, ?, ?, ?)',
+            (name_recording, response_recording, timestamp or datetime.now().isoformat(), caller),
+        )
+        return cursor.lastrowid
+
+    def add_responses(self, records):
+        conn = self._connect()
+        with self._transaction(conn):
+            conn.executemany(
+                'INSERT INTO responses (name_recording, response_recording, timestamp, caller) VALUES (?, ?, ?, ?)',
+                [(record.get('name_recording'), record['response_recording'],
+                  record.get('timestamp') or datetime.now().isoformat(), record.get('caller'))
+                 for record in records],
+            )
+
+    def list_responses(self, caller=None, since=None, until=None, after_id=None, limit=None):
+        clauses, params = [], []
+        if caller is not None:
+            clauses.append('caller = ?')
+            params.append(caller)
+        if since is not None:
+            clauses.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('timestamp < ?')
+            params.append(until)
+        if after_id is not None:
+            clauses.append('id > ?')
+            params.append(after_id)
+        sql = 'SELECT {} FROM responses'.format(', '.join(RESPONSE_FIELDS))
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [dict(row) for row in self._connect().execute(sql, params)]
+
+    def latest_response(self):
+        row = self._connect().execute(
+            'SELECT {} FROM responses ORDER BY id DESC LIMIT 1'.format(', '.join(RESPONSE_FIELDS))
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def set_pastor_message(self, url, timestamp=None, media_id=None):
+        conn = self._connect()
+        with self._transaction(conn):
+            latest = conn.execute('SELECT url FROM pastor_messages ORDER BY id DESC LIMIT 1').fetchone()
+            if latest is not None and latest['url'] == url:
+                return
+            conn.execute(
+                'INSERT INTO pastor_messages (url, timestamp, media_id) VALUES (?, ?, ?)',
+                (url, timestamp or datetime.now().isoformat(), media_id),
+            )
+
+    def set_pastor_media(self, url, media_id):
+        self._connect().execute('UPDATE pastor_messages SET media_id = ? WHERE url = ?', (media_id, url))
+
+    def get_pastor_message(self):
+        row = self._connect().execute(
+            'SELECT url, timestamp, media_id FROM pastor_messages ORDER BY id DESC LIMIT 1'
+        ).fetchone()
+        if row is None:
+            return {'url': None, 'timestamp': None, 'media_id': None}
+        return dict(row)
+
+    def save_recordings(self, recordings):
+        conn = self._connect()
+        with self._transaction(conn):
+            # Twilio retries callbacks, so the same RecordingSid may arrive more than once
+            conn.executemany(
+                'INSERT INTO recordings (recording_sid, call_sid, status, url, duration, updated_at) '
+                'VALUES (:recording_sid, :call_sid, :status, :url, :duration, :updated_at) '
+                'ON CONFLICT (recording_sid) DO UPDATE SET status = excluded.status, url = excluded.url, '
+                'duration = excluded.duration, updated_at = excluded.updated_at',
+                recordings,
+            )
+
+    def call_states(self):
+        return SQLiteCallStates(self)
+
+    def token_buckets(self, burst, refill_seconds):
+        return SQLiteTokenBuckets(self, burst, refill_seconds)
+
+    def broadcasts(self):
+        return SQLiteBroadcasts(self)
+
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+class SQLiteCallStates:
+    """Call state in the shared database so any worker can serve any step of a call."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, call_sid):
+        row = self.store._connect().execute(
+            'SELECT state FROM call_states WHERE call_sid = ?', (call_sid,)
+        ).fetchone()
+        return json.loads(row['state']) if row is not None else None
+
+    def put(self, call_sid, state, updated_at):
+        self.store._connect().execute(
+            'INSERT INTO call_states (call_sid, state, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (call_sid) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at',
+            (call_sid, json.dumps(state), updated_at),
+        )
+
+    def delete(self, call_sid):
+        self.store._connect().execute('DELETE FROM call_states WHERE call_sid = ?', (call_sid,))
+
+    def pop_expired(self, before):
+        # Claim and delete in one write transaction so concurrent sweeps never finalize a call twice
+        conn = self.store._connect()
+        with self.store._transaction(conn):
+            rows = conn.execute('SELECT state FROM call_states WHERE updated_at < ?', (before,)).fetchall()
+            conn.execute('DELETE FROM call_states WHERE updated_at < ?', (before,))
+        return [json.loads(row['state']) for row in rows]
+
+
+class SQLiteBroadcasts:
+    """Broadcast recipients and the dialer lease in the shared database, so any worker can dial."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def create_broadcast(self, message_url, recipients):
+        now = time.time()
+        conn = self.store._connect()
+        with self.store._transaction(conn):
+            existing = conn.execute('SELECT id FROM broadcasts WHERE message_url = ? ORDER BY id LIMIT 1',
+                                    (message_url,)).fetchone()
+            if existing is not None:
+                return existing['id']
+            conn.execute(
+                "UPDATE broadcast_recipients SET status = 'superseded', updated_at = ? WHERE status IN (?, ?)",
+                (now,) + UNDIALED_STATUSES,
+            )
+            broadcast_id = conn.execute(
+                'INSERT INTO broadcasts (message_url, created_at) VALUES (?, ?)',
+                (message_url, datetime.now().isoformat()),
+            ).lastrowid
+            conn.executemany(
+                'INSERT INTO broadcast_recipients (broadcast_id, phone, name, congregation, status, '
+                "next_attempt_at, updated_at) VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                [(broadcast_id, r['phone'], r.get('name'), r.get('congregation'), now, now) for r in recipients],
+            )
+        return broadcast_id
+
+    def has_due_recipients(self, now, stale_before):
+        row = self.store._connect().execute(
+            'SELECT 1 FROM broadcast_recipients '
+            "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'dialing' AND claimed_at < ?) LIMIT 1",
+            (now, stale_before),
+        ).fetchone()
+        return row is not None
+
+    def claim_recipients(self, limit, now, stale_before):
+        conn = self.store._connect()
+        with self.store._transaction(conn):
+            rows = conn.execute(
+                'SELECT {} FROM broadcast_recipients '
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'dialing' AND claimed_at < ?) "
+                'ORDER BY id LIMIT ?'.format(', '.join(RECIPIENT_FIELDS)),
+                (now, stale_before, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE broadcast_recipients SET status = 'dialing', claimed_at = ?, updated_at = ? WHERE id = ?",
+                [(now, now, row['id']) for row in rows],
+            )
+        return [dict(row, status='dialing', claimed_at=now, updated_at=now) for row in rows]
+
+    def update_recipient(self, recipient_id, **fields):
+        fields['updated_at'] = time.time()
+        self.store._connect().execute(
+            'UPDATE broadcast_recipients SET {} WHERE id = ?'.format(
+                ', '.join('{} = ?'.format(name) for name in fields if name in RECIPIENT_FIELDS)),
+            [value for name, value in fields.items() if name in RECIPIENT_FIELDS] + [recipient_id],
+        )
+
+    def update_recipient_status(self, call_sid, status):
+        self.store._connect().execute(
+            'UPDATE broadcast_recipients SET status = ?, updated_at = ? WHERE call_sid = ?',
+            (status, time.time(), call_sid),
+        )
+
+    def get_broadcast(self, broadcast_id):
+        conn = self.store._connect()
+        row = conn.execute('SELECT id, message_url, created_at FROM broadcasts WHERE id = ?',
+                           (broadcast_id,)).fetchone()
+        if row is None:
+            return None
+        broadcast = dict(row)
+        broadcast['recipients'] = [dict(r) for r in conn.execute(
+            'SELECT {} FROM broadcast_recipients WHERE broadcast_id = ? ORDER BY id'.format(
+                ', '.join(RECIPIENT_FIELDS)), (broadcast_id,))]
+        return broadcast
+
+    def acquire_lease(self, name, owner, expires_at, now):
+        conn = self.store._connect()
+        conn.execute(
+            'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+            'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+            (name, owner, expires_at, now),
+        )
+        row = conn.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()
+        return row['owner'] == owner
+
+
+class SQLiteTokenBuckets:
+    """Token buckets in the shared database, so every worker draws on the same budget."""
+
+    def __init__(self, store, burst, refill_seconds):
+        self.store = store
+        self.burst = burst
+        self.rate = 1.0 / refill_seconds
+
+    def _tokens(self, row, now):
+        if row is None:
+            return self.burst
+        return min(self.burst, row['tokens'] + (now - row['updated_at']) * self.rate)
+
+    def allowed(self, key):
+        row = self.store._connect().execute(
+            'SELECT tokens, updated_at FROM token_buckets WHERE key = ?', (key,)
+        ).fetchone()
+        return self._tokens(row, time.time()) >= 1
+
+    def consume(self, key):
+        """Take a token and return whether one was available."""
+        now = time.time()
+        conn = self.store._connect()
+        with self.store._transaction(conn):
+            row = conn.execute('SELECT tokens, updated_at FROM token_buckets WHERE key = ?', (key,)).fetchone()
+            tokens = self._tokens(row, now)
+            allowed = tokens >= 1
+            conn.execute(
+                'INSERT INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+                (key, tokens - 1 if allowed else tokens, now),
+            )
+        return allowed
+
+
+def create_store():
+    backend = os.environ.get('STORE_BACKEND', 'sqlite')
+    if backend == 'memory':
+        return MemoryStore()
+    if backend == 'sqlite':
+        return SQLiteStore(os.environ.get('STORE_PATH', 'ivr.db'))
+    raise ValueError('Unknown STORE_BACKEND: {}'.format(backend))
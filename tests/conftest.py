@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py configures itself from the environment at import, so pin it to throwaway state first
+_STATE_DIR = tempfile.mkdtemp(prefix='ivr-tests-')
+os.environ.update({
+    'STORE_PATH': os.path.join(_STATE_DIR, 'ivr.db'),
+    'MEDIA_CACHE_DIR': '',
+    'METRICS_DIR': '',
+    'JOB_WORKERS': '0',
+    'MEDIA_JOB_WORKERS': '0',
+    'BROADCAST_ENABLED': '',
+    'PIN_DIRECTORY': '',
+})
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    """Each store backend in turn."""
+    from store import MemoryStore, SQLiteStore
+
+    if request.param == 'memory':
+        return MemoryStore()
+    return SQLiteStore(str(tmp_path / 'ivr.db'))
+
+
+@pytest.fixture
+def wait_for():
+    """Poll predicate until it is true or timeout seconds pass; returns whether it became true."""
+    def wait(predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.01)
+        return False
+    return wait
+
+
+@pytest.fixture
+def ivr(monkeypatch, tmp_path):
+    """The Flask app on a fresh store, with fresh PIN limiters."""
+    import app
+    from callstate import CallStateStore
+    from ratelimit import TokenBucketLimiter
+    from store import SQLiteStore
+
+    store = SQLiteStore(str(tmp_path / 'ivr.db'))
+    monkeypatch.setattr(app, 'store', store)
+    monkeypatch.setattr(app, 'call_states', CallStateStore(store.call_states(),
+                                                           on_abandoned=app.finalize_abandoned_call))
+    monkeypatch.setattr(app, 'caller_pin_failures', TokenBucketLimiter(5, 60))
+    monkeypatch.setattr(app, 'pin_failures', store.token_buckets(10, 30))
+    for kind, handler in (('save_response', store.add_responses), ('recording_status', store.save_recordings)):
+        monkeypatch.setitem(app.jobs._handlers, kind, handler)
+    monkeypatch.setattr(app.jobs, '_seen', type(app.jobs._seen)())
+    return app
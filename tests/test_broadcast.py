@@ -0,0 +1,180 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from twilio.base.exceptions import TwilioRestException
+
+from broadcast import BroadcastDialer
+
+
+class FakeCalls:
+    def __init__(self, errors=(), delay=0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.placed = []
+        self._lock = threading.Lock()
+
+    def create(self, to, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            self.placed.append((to, time.monotonic()))
+            if self.errors:
+                raise self.errors.pop(0)
+            return SimpleNamespace(sid='CA{}'.format(len(self.placed)), status='queued')
+
+
+@pytest.fixture
+def broadcasts(store):
+    return store.broadcasts()
+
+
+def make_dialer(broadcasts, calls, **kwargs):
+    options = dict(calls_per_second=1000, workers=3, backoff=0, max_backoff=0, poll_interval=0.01)
+    options.update(kwargs)
+    return BroadcastDialer(broadcasts, SimpleNamespace(calls=calls), '+15550000000', 'https://ivr/play',
+                           'https://ivr/status', **options)
+
+
+def recipients(count):
+    return [{'phone': '+1555000{:04d}'.format(i), 'name': 'M{}'.format(i)} for i in range(count)]
+
+
+def test_each_recipient_is_dialed_once(broadcasts, wait_for):
+    calls = FakeCalls(delay=0.05)
+    broadcast_id = broadcasts.create_broadcast('https://media/message.mp3', recipients(10))
+    dialer = make_dialer(broadcasts, calls)
+    dialer.ensure_started()
+    try:
+        assert wait_for(lambda: all(r['status'] == 'queued' for r in broadcasts.get_broadcast(broadcast_id)['recipients']))
+        time.sleep(0.1)
+    finally:
+        dialer.stop()
+    phones = [to for to, _ in calls.placed]
+    assert sorted(phones) == sorted(r['phone'] for r in recipients(10))
+    assert {r['call_sid'] for r in broadcasts.get_broadcast(broadcast_id)['recipients']} == {
+        'CA{}'.format(i) for i in range(1, 11)}
+
+
+def test_slow_pacing_does_not_make_claims_stale(broadcasts, wait_for):
+    # Ten calls at 20/s take half a second; a claim timeout shorter than that must not re-dial anyone
+    calls = FakeCalls()
+    broadcast_id = broadcasts.create_broadcast('https://media/message.mp3', recipients(10))
+    dialer = make_dialer(broadcasts, calls, calls_per_second=20, claim_timeout=0.05)
+    dialer.ensure_started()
+    try:
+        assert wait_for(lambda: all(r['status'] == 'queued' for r in broadcasts.get_broadcast(broadcast_id)['recipients']))
+        time.sleep(0.2)
+    finally:
+        dialer.stop()
+    assert len(calls.placed) == 10
+    times = [at for _, at in calls.placed]
+    assert times[-1] - times[0] >= 9 * 0.05 * 0.9
+
+
+def test_calls_are_paced(broadcasts):
+    calls = FakeCalls()
+    dialer = make_dialer(broadcasts, calls, calls_per_second=50)
+    broadcasts.create_broadcast('https://media/message.mp3', recipients(5))
+    for recipient in broadcasts.claim_recipients(5, time.time(), 0):
+        dialer.dial(recipient)
+    times = [at for _, at in calls.placed]
+    assert times[-1] - times[0] >= 4 * 0.02 * 0.9
+
+
+@pytest.mark.parametrize('error', [
+    TwilioRestException(500, '/Calls', 'Internal error'),
+    TwilioRestException(429, '/Calls', 'Too many requests'),
+    ConnectionError('reset'),
+])
+def test_transient_errors_are_retried(broadcasts, error):
+    calls = FakeCalls(errors=[error])
+    broadcast_id = broadcasts.create_broadcast('https://media/message.mp3', recipients(1))
+    dialer = make_dialer(broadcasts, calls)
+
+    dialer.dial(broadcasts.claim_recipients(1, time.time(), 0)[0])
+    recipient = broadcasts.get_broadcast(broadcast_id)['recipients'][0]
+    assert (recipient['status'], recipient['attempts']) == ('pending', 1)
+
+    dialer.dial(broadcasts.claim_recipients(1, time.time() + 1, 0)[0])
+    recipient = broadcasts.get_broadcast(broadcast_id)['recipients'][0]
+    assert (recipient['status'], recipient['attempts'], recipient['call_sid']) == ('queued', 2, 'CA2')
+
+
+def test_client_errors_fail_without_retry(broadcasts):
+    calls = FakeCalls(errors=[TwilioRestException(400, '/Calls', 'Invalid To number')])
+    broadcast_id = broadcasts.create_broadcast('https://media/message.mp3', recipients(1))
+    make_dialer(broadcasts, calls).dial(broadcasts.claim_recipients(1, time.time(), 0)[0])
+    recipient = broadcasts.get_broadcast(broadcast_id)['recipients'][0]
+    assert (recipient['status'], recipient['attempts']) == ('failed', 1)
+    assert broadcasts.claim_recipients(1, time.time() + 3600, 0) == []
+
+
+def test_gives_up_after_max_attempts(broadcasts):
+    calls = FakeCalls(errors=[TwilioRestException(503, '/Calls', 'Unavailable')] * 2)
+    broadcast_id = broadcasts.create_broadcast('https://media/message.mp3', recipients(1))
+    dialer = make_dialer(broadcasts, calls, max_attempts=2)
+    for _ in range(2):
+        dialer.dial(broadcasts.claim_recipients(1, time.time() + 1, 0)[0])
+    recipient = broadcasts.get_broadcast(broadcast_id)['recipients'][0]
+    assert (recipient['status'], recipient['attempts']) == ('failed', 2)
+
+
+def test_only_the_lease_holder_dials(broadcasts, wait_for):
+    calls = FakeCalls()
+    broadcast_id = broadcasts.create_broadcast('https://media/message.mp3', recipients(4))
+    # Each dialer stands in for a gunicorn worker: same store, its own lease owner
+    dialers = [make_dialer(broadcasts, calls, lease_seconds=60) for _ in range(3)]
+    for dialer in dialers:
+        dialer.ensure_started()
+    try:
+        assert wait_for(lambda: all(r['status'] == 'queued' for r in broadcasts.get_broadcast(broadcast_id)['recipients']))
+    finally:
+        for dialer in dialers:
+            dialer.stop()
+    assert len(calls.placed) == 4
+
+
+def test_a_new_message_supersedes_undialed_recipients(broadcasts):
+    first = broadcasts.create_broadcast('https://media/first.mp3', recipients(2))
+    second = broadcasts.create_broadcast('https://media/second.mp3', recipients(2))
+    assert {r['status'] for r in broadcasts.get_broadcast(first)['recipients']} == {'superseded'}
+    assert {r['broadcast_id'] for r in broadcasts.claim_recipients(10, time.time(), 0)} == {second}
+
+
+def test_creating_a_broadcast_twice_for_a_message_is_a_no_op(broadcasts):
+    first = broadcasts.create_broadcast('https://media/message.mp3', recipients(2))
+    assert broadcasts.create_broadcast('https://media/message.mp3', recipients(2)) == first
+    assert len(broadcasts.claim_recipients(10, time.time(), 0)) == 2
+
+
+def test_lease_is_held_until_it_expires(broadcasts):
+    assert broadcasts.acquire_lease('dialer', 'a', expires_at=10, now=0)
+    assert not broadcasts.acquire_lease('dialer', 'b', expires_at=20, now=5)
+    assert broadcasts.acquire_lease('dialer', 'a', expires_at=20, now=5)
+    assert broadcasts.acquire_lease('dialer', 'b', expires_at=40, now=21)
+
+
+def test_due_recipients_are_found_without_claiming_them(broadcasts):
+    assert not broadcasts.has_due_recipients(time.time(), 0)
+    broadcasts.create_broadcast('https://media/message.mp3', recipients(1))
+    assert broadcasts.has_due_recipients(time.time(), 0)
+    claimed = broadcasts.claim_recipients(1, time.time(), 0)
+    assert not broadcasts.has_due_recipients(time.time(), 0)
+    # A claim older than stale_before is due again
+    assert broadcasts.has_due_recipients(time.time(), claimed[0]['claimed_at'] + 1)
+
+
+def test_an_idle_dialer_never_takes_the_lease(broadcasts, wait_for):
+    leases = []
+    acquire_lease = broadcasts.acquire_lease
+    broadcasts.acquire_lease = lambda *args: leases.append(args) or acquire_lease(*args)
+    dialer = make_dialer(broadcasts, FakeCalls())
+    dialer.ensure_started()
+    try:
+        time.sleep(0.1)
+        assert leases == []
+        broadcasts.create_broadcast('https://media/message.mp3', recipients(1))
+        assert wait_for(lambda: leases)
+    finally:
+        dialer.stop()
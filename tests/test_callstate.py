@@ -0,0 +1,40 @@
+from callstate import CallStateStore, MemoryCallStates
+from store import SQLiteStore
+
+
+def test_update_returns_the_previous_state():
+    states = CallStateStore(MemoryCallStates())
+    assert states.update('CA1', step='voice') == {}
+    assert states.update('CA1', step='pin')['step'] == 'voice'
+    assert states.get('CA1') == {'call_sid': 'CA1', 'step': 'pin'}
+    assert states.update(None, step='voice') == {}
+
+
+def test_sweep_finalizes_abandoned_calls(tmp_path):
+    abandoned = []
+    states = CallStateStore(SQLiteStore(str(tmp_path / 'ivr.db')).call_states(), ttl=60,
+                            on_abandoned=abandoned.append)
+    states.update('CA1', step='record')
+    states.update('CA2', step='voice')
+    states.finish('CA2')
+    assert states.sweep() == 0
+    assert states.sweep(now=10 ** 12) == 1
+    assert [state['call_sid'] for state in abandoned] == ['CA1']
+    assert states.get('CA1') == {}
+
+
+def test_memory_backend_finalizes_evicted_calls():
+    abandoned = []
+    states = CallStateStore(MemoryCallStates(max_calls=1), on_abandoned=abandoned.append)
+    states.update('CA1', step='record')
+    states.update('CA2', step='record')
+    states.sweep()
+    assert [state['call_sid'] for state in abandoned] == ['CA1']
+
+
+def test_abandoned_recordings_are_saved(ivr):
+    client = ivr.app.test_client()
+    client.post('/handle-pin', data={'Digits': '777', 'From': '+1555', 'CallSid': 'CA9'})
+    client.post('/handle-response-menu', data={'RecordingUrl': 'https://r/9', 'CallSid': 'CA9'})
+    ivr.call_states.sweep(now=10 ** 12)
+    assert [r['response_recording'] for r in ivr.store.list_responses()] == ['https://r/9']
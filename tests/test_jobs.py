@@ -0,0 +1,70 @@
+import time
+
+from jobs import Job, JobQueue
+
+
+def test_jobs_are_batched_by_kind():
+    batches = []
+    queue = JobQueue(workers=0)
+    queue.register('write', batches.append)
+    queue.register('other', batches.append)
+    queue._run([Job('write', 0), Job('other', 1), Job('write', 2)])
+    assert batches == [[0, 2], [1]]
+
+
+def test_failed_batches_are_retried(wait_for):
+    attempts = []
+
+    def flaky(payloads):
+        attempts.append(payloads)
+        if len(attempts) < 3:
+            raise RuntimeError('database is locked')
+
+    queue = JobQueue(workers=1, backoff=0.01)
+    queue.register('write', flaky)
+    queue.submit('write', {'n': 1})
+    try:
+        assert wait_for(lambda: queue.stats()['processed'] == 1)
+    finally:
+        queue.stop(timeout=5)
+    assert len(attempts) == 3 and queue.stats()['retried'] == 2
+
+
+def test_duplicate_keys_are_ignored_while_pending_or_done():
+    done = []
+    queue = JobQueue(workers=0)
+    queue.register('write', done.extend)
+    assert queue.submit('write', {'n': 1}, key='a')
+    assert not queue.submit('write', {'n': 2}, key='a')
+    assert queue.submit('write', {'n': 3}, key='b')
+    assert done == [{'n': 1}, {'n': 3}]
+
+
+def test_a_dropped_job_releases_its_key(wait_for):
+    calls = []
+
+    def broken(payloads):
+        calls.append(payloads)
+        raise RuntimeError('down')
+
+    queue = JobQueue(workers=1, max_attempts=2, backoff=0.01)
+    queue.register('write', broken)
+    queue.submit('write', {'n': 1}, key='a')
+    try:
+        assert wait_for(lambda: queue.stats()['failed'] == 1)
+        # A redelivery of the same callback is accepted once the first copy was given up on
+        assert queue.submit('write', {'n': 1}, key='a')
+        assert wait_for(lambda: queue.stats()['failed'] == 2)
+    finally:
+        queue.stop(timeout=5)
+    assert len(calls) == 4
+
+
+def test_stop_flushes_queued_jobs():
+    done = []
+    queue = JobQueue(workers=1, batch_size=10)
+    queue.register('write', lambda payloads: (time.sleep(0.05), done.extend(payloads)))
+    for n in range(20):
+        queue.submit('write', n)
+    queue.stop(timeout=5)
+    assert sorted(done) == list(range(20))
@@ -0,0 +1,125 @@
+import hashlib
+import os
+
+import pytest
+
+from loadtest import FakeRecordingHandler, start_fake_media_server
+from media import MediaCache, http_fetcher
+
+SIZE = 1024
+SMALL = FakeRecordingHandler.recording('/Recordings/RE1.mp3', SIZE)
+
+
+@pytest.fixture(scope='module')
+def recordings():
+    server, url = start_fake_media_server()
+    yield url
+    server.shutdown()
+
+
+def recording_url(recordings, name, size=SIZE):
+    return '{}/Recordings/{}.mp3?bytes={}'.format(recordings, name, size)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MediaCache(str(tmp_path / 'media'), max_bytes=4096, fetcher=http_fetcher(),
+                      allowed_hosts=['127.0.0.1'])
+
+
+def test_fetch_is_content_addressed(cache, recordings):
+    media_id = cache.fetch(recording_url(recordings, 'RE1'))
+    assert media_id == hashlib.sha256(SMALL).hexdigest()
+    assert cache.fetch(recording_url(recordings, 'RE1') + '&Download=true') == media_id
+    with open(cache.path(media_id), 'rb') as f:
+        assert f.read() == SMALL
+    assert os.listdir(cache.directory) == [media_id + '.mp3']
+
+
+def test_oversize_download_leaves_no_part_file(cache, recordings):
+    with pytest.raises(ValueError):
+        cache.fetch(recording_url(recordings, 'RE-long', size=8192))
+    assert os.listdir(cache.directory) == []
+
+
+def test_hosts_outside_the_allow_list_are_refused(cache):
+    with pytest.raises(ValueError, match='Refusing'):
+        cache.fetch('http://169.254.169.254/latest/meta-data')
+
+
+def test_least_recently_used_file_is_evicted(tmp_path, recordings):
+    cache = MediaCache(str(tmp_path / 'media'), max_bytes=SIZE * 2 - 1, fetcher=http_fetcher(),
+                       allowed_hosts=['127.0.0.1'])
+    first = cache.fetch(recording_url(recordings, 'RE1'))
+    os.utime(cache.path(first), (1, 1))
+    second = cache.fetch(recording_url(recordings, 'RE2'))
+    assert cache.path(first) is None
+    assert cache.path(second) is not None
+
+
+def test_path_rejects_anything_but_a_media_id(cache):
+    assert cache.path('../../etc/passwd') is None
+    assert cache.path('0' * 64) is None
+
+
+@pytest.fixture
+def served(ivr, monkeypatch, cache, recordings):
+    monkeypatch.setattr(ivr, 'media_cache', cache)
+    return ivr, cache.fetch(recording_url(recordings, 'RE1'))
+
+
+def test_media_supports_ranges(served):
+    ivr, media_id = served
+    response = ivr.app.test_client().get('/media/{}.mp3'.format(media_id), headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert response.data == SMALL[:100]
+    assert response.headers['Content-Range'] == 'bytes 0-99/{}'.format(len(SMALL))
+
+
+def test_media_revalidates_with_its_etag(served):
+    ivr, media_id = served
+    client = ivr.app.test_client()
+    response = client.get('/media/{}.mp3'.format(media_id))
+    assert response.status_code == 200 and response.data == SMALL
+    assert 'immutable' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert client.get('/media/{}.mp3'.format(media_id), headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/media/{}.mp3'.format('0' * 64)).status_code == 404
+
+
+def test_pastor_message_is_played_from_the_cache(ivr, monkeypatch, cache, recordings):
+    monkeypatch.setattr(ivr, 'media_cache', cache)
+    client = ivr.app.test_client()
+    client.post('/save-pastor-message', data={'RecordingUrl': recordings + '/Recordings/RE-play?bytes=1024',
+                                              'RecordingSid': 'RE-play', 'CallSid': 'CA1'})
+    body = client.post('/play-pastor-message', data={'CallSid': 'CA2', 'From': '+1555'}).data
+    expected = FakeRecordingHandler.recording('/Recordings/RE-play.mp3', SIZE)
+    assert '/media/{}.mp3'.format(hashlib.sha256(expected).hexdigest()).encode() in body
+
+
+def test_a_recording_that_is_not_ready_yet_is_retried(ivr, monkeypatch, tmp_path, recordings, wait_for):
+    from jobs import JobQueue
+
+    fetch = http_fetcher()
+    attempts = []
+
+    def not_ready_at_first(url):
+        attempts.append(url)
+        if len(attempts) == 1:
+            raise OSError('HTTP Error 404: Not Found')
+        return fetch(url)
+
+    media_jobs = JobQueue(workers=1, backoff=0.01, name='media')
+    media_jobs.register('cache_media', ivr.cache_pastor_media)
+    monkeypatch.setattr(ivr, 'media_jobs', media_jobs)
+    monkeypatch.setattr(ivr, 'media_cache', MediaCache(str(tmp_path / 'media'), 4096, not_ready_at_first,
+                                                       allowed_hosts=['127.0.0.1']))
+    ivr.app.test_client().post('/save-pastor-message', data={
+        'RecordingUrl': recordings + '/Recordings/RE-late?bytes=1024', 'RecordingSid': 'RE-late', 'CallSid': 'CA1'})
+    try:
+        assert wait_for(lambda: ivr.store.get_pastor_message()['media_id'] is not None)
+    finally:
+        media_jobs.stop(timeout=5)
+    expected = FakeRecordingHandler.recording('/Recordings/RE-late.mp3', SIZE)
+    assert ivr.store.get_pastor_message()['media_id'] == hashlib.sha256(expected).hexdigest()
+    assert len(attempts) == 2
@@ -0,0 +1,124 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+from metrics import Registry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def samples(text):
+    return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+
+def worker(directory, depth=0, lag=0.0):
+    """A registry as one gunicorn worker would define it."""
+    registry = Registry(str(directory))
+    registry.counter('requests_total', 'Requests', ('route',))
+    registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    registry.gauge('queue_depth', 'Depth', collect=lambda: {(): depth})
+    registry.gauge('queue_lag_seconds', 'Lag', collect=lambda: {(): lag}, aggregate='max')
+    return registry
+
+
+def metric(registry, name):
+    return next(m for m in registry._metrics if m.name == name)
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def test_workers_are_merged_by_kind(tmp_path):
+    first, second = worker(tmp_path, depth=3, lag=2.0), worker(tmp_path, depth=4, lag=5.0)
+    for registry, count in ((first, 2), (second, 5)):
+        metric(registry, 'requests_total').inc('/voice', amount=count)
+        metric(registry, 'latency_seconds').observe(0.5)
+    first.flush()
+    merged = samples(second.render())
+    assert merged['requests_total{route="/voice"}'] == '7'
+    assert merged['latency_seconds_bucket{le="0.1"}'] == '0'
+    assert merged['latency_seconds_bucket{le="1.0"}'] == '2'
+    assert merged['latency_seconds_count'] == '2'
+    assert merged['queue_depth'] == '7'
+    assert merged['queue_lag_seconds'] == '5.0'
+
+
+def test_dead_workers_keep_counters_but_drop_gauges(tmp_path):
+    registry = worker(tmp_path)
+    snapshot = {'requests_total': {'/voice': 4}, 'queue_depth': {'': 9}, 'queue_lag_seconds': {'': 60.0}}
+    (tmp_path / '{}-0a1b2c3d.json'.format(dead_pid())).write_text(json.dumps(snapshot))
+    merged = samples(registry.render())
+    assert merged['requests_total{route="/voice"}'] == '4'
+    assert merged['queue_depth'] == '0'
+    assert merged['queue_lag_seconds'] == '0.0'
+
+
+def test_marked_dead_files_are_renamed_and_skipped_for_gauges(tmp_path):
+    # The pid is still running (it is ours), so only the rename can tell render it has exited
+    other = worker(tmp_path, depth=5)
+    metric(other, 'requests_total').inc('/voice')
+    other.flush()
+    metrics.mark_process_dead(str(tmp_path), os.getpid())
+    assert [path.name.endswith('.dead.json') for path in tmp_path.iterdir()] == [True]
+    merged = samples(worker(tmp_path).render())
+    assert merged['requests_total{route="/voice"}'] == '1'
+    assert merged['queue_depth'] == '0'
+
+
+def test_a_reused_pid_never_overwrites_an_earlier_worker(tmp_path):
+    first, second = worker(tmp_path), worker(tmp_path)
+    metric(first, 'requests_total').inc('/voice', amount=3)
+    first.flush()
+    second.flush()
+    assert len(list(tmp_path.glob('{}-*.json'.format(os.getpid())))) == 2
+    assert samples(second.render())['requests_total{route="/voice"}'] == '3'
+
+
+def test_clear_directory_removes_every_snapshot(tmp_path):
+    registry = worker(tmp_path)
+    registry.flush()
+    (tmp_path / '1-deadbeef.dead.json').write_text('{}')
+    (tmp_path / '2-deadbeef.json.tmp').write_text('{')
+    metrics.clear_directory(str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_a_failed_flush_is_logged_not_raised(tmp_path, caplog):
+    registry = worker(tmp_path / 'gone')
+    os.rmdir(str(tmp_path / 'gone'))
+    registry.maybe_flush()
+    assert 'Could not write metrics snapshot' in caplog.text
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.counter('c', 'C', ('route',)).inc('a"b\\c\nd')
+    assert 'c{route="a\\"b\\\\c\\nd"} 1' in registry.render()
+
+
+@pytest.fixture
+def gunicorn_conf(monkeypatch, tmp_path):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', os.path.join(ROOT, 'gunicorn.conf.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_gunicorn_hooks_clear_at_start_and_mark_exited_workers(gunicorn_conf, tmp_path):
+    (tmp_path / '1-deadbeef.json').write_text('{}')
+    gunicorn_conf.on_starting(SimpleNamespace())
+    assert list(tmp_path.iterdir()) == []
+    (tmp_path / '42-deadbeef.json').write_text('{}')
+    (tmp_path / '43-deadbeef.json').write_text('{}')
+    gunicorn_conf.child_exit(SimpleNamespace(), SimpleNamespace(pid=42))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['42-deadbeef.dead.json', '43-deadbeef.json']
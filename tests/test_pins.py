@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from pins import PinDirectory, hash_pin, load_pin_file
+
+INVALID = b'Invalid PIN'
+THROTTLED = b'Too many PIN attempts'
+
+
+def enter_pin(client, digits, caller='+15551230000', call_sid='CA1'):
+    return client.post('/handle-pin', data={'Digits': digits, 'From': caller, 'CallSid': call_sid}).data
+
+
+def test_shared_pin_is_never_throttled(ivr):
+    client = ivr.app.test_client()
+    for i in range(50):
+        body = enter_pin(client, '777', call_sid='CA{}'.format(i))
+        assert b'<Record' in body
+
+
+def test_repeated_failures_from_a_caller_are_throttled(ivr):
+    client = ivr.app.test_client()
+    for _ in range(5):
+        assert INVALID in enter_pin(client, '123')
+    assert THROTTLED in enter_pin(client, '123')
+    # Even the right PIN is refused until the caller's bucket refills
+    assert THROTTLED in enter_pin(client, '888')
+    assert b'<Record' in enter_pin(client, '888', caller='+15559990000')
+
+
+def test_guessing_different_pins_from_different_numbers_is_throttled(ivr):
+    client = ivr.app.test_client()
+    guesses = ['{:03d}'.format(pin) for pin in range(100, 1000) if pin not in (777, 888)]
+    results = [enter_pin(client, pin, caller='+1555000{:04d}'.format(i)) for i, pin in enumerate(guesses[:11])]
+    assert all(INVALID in body for body in results[:10])
+    assert THROTTLED in results[10]
+
+
+def test_the_failure_budget_is_shared_by_every_worker(ivr):
+    from store import SQLiteStore
+
+    # A second store on the same file stands in for another gunicorn worker
+    other = SQLiteStore(ivr.store.path).token_buckets(10, 30)
+    for _ in range(10):
+        other.consume(ivr.PIN_FAILURES_KEY)
+    assert THROTTLED in enter_pin(ivr.app.test_client(), '123')
+
+
+def write_pins(path, rows):
+    path.write_text('pin,role,name,congregation,phone\n' + ''.join(','.join(row) + '\n' for row in rows))
+
+
+def test_directory_reloads_when_the_file_changes(tmp_path):
+    path = tmp_path / 'pins.csv'
+    write_pins(path, [('111', 'pastor', 'Pastor Ann', '', '')])
+    directory = PinDirectory(str(path), check_interval=0)
+    assert directory.lookup('111').name == 'Pastor Ann'
+    assert directory.lookup('222') is None
+
+    write_pins(path, [('111', 'pastor', 'Pastor Ann', '', ''), ('222', 'missionary', 'Ruth', 'Lima', '+15550001')])
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert directory.lookup('222').congregation == 'Lima'
+    assert [entry.name for entry in directory.entries('missionary')] == ['Ruth']
+
+
+def test_a_broken_file_keeps_the_previous_pins(tmp_path):
+    path = tmp_path / 'pins.csv'
+    write_pins(path, [('111', 'pastor', 'Pastor Ann', '', '')])
+    directory = PinDirectory(str(path), check_interval=0)
+    write_pins(path, [('111', 'bishop', 'Pastor Ann', '', '')])
+    assert directory.lookup('111').name == 'Pastor Ann'
+
+
+def test_hashed_pins_and_validation(tmp_path):
+    path = tmp_path / 'pins.csv'
+    path.write_text('pin_sha256,role\n{},missionary\n'.format(hash_pin('456')))
+    assert load_pin_file(str(path))[hash_pin('456')].role == 'missionary'
+    path.write_text('pin,role\n456,missionary\n456,pastor\n')
+    with pytest.raises(ValueError, match='duplicate'):
+        load_pin_file(str(path))
+
+
+def test_default_pins_match_the_original_ivr():
+    directory = PinDirectory()
+    assert directory.lookup('888').role == 'pastor'
+    assert directory.lookup('777').role == 'missionary'
@@ -0,0 +1,47 @@
+import ratelimit
+from ratelimit import TokenBucketLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_then_refill(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    limiter = TokenBucketLimiter(burst=3, refill_seconds=10)
+    assert [limiter.consume('a') for _ in range(4)] == [True, True, True, False]
+    clock.now += 10
+    assert limiter.consume('a')
+    assert not limiter.consume('a')
+
+
+def test_allowed_does_not_take_a_token(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    limiter = TokenBucketLimiter(burst=1, refill_seconds=10)
+    assert limiter.allowed('a') and limiter.allowed('a')
+    limiter.consume('a')
+    assert not limiter.allowed('a')
+    assert limiter.allowed('b')
+
+
+def test_keys_are_bounded():
+    limiter = TokenBucketLimiter(burst=1, refill_seconds=60, max_keys=2)
+    for key in 'abc':
+        limiter.consume(key)
+    # The least recently used key was forgotten and starts over with a full bucket
+    assert limiter.allowed('a')
+    assert not limiter.allowed('c')
+
+
+def test_store_buckets_share_a_budget(store):
+    buckets = store.token_buckets(burst=2, refill_seconds=3600)
+    assert buckets.allowed('pins')
+    assert [buckets.consume('pins') for _ in range(3)] == [True, True, False]
+    assert not buckets.allowed('pins')
+    assert buckets.allowed('other')
@@ -0,0 +1,79 @@
+import json
+
+
+def add_responses(ivr, count):
+    ivr.store.add_responses([{'name_recording': None, 'response_recording': 'https://r/{}'.format(i),
+                              'caller': '+1', 'timestamp': '2024-01-01T00:00:{:02d}'.format(i)}
+                             for i in range(count)])
+
+
+def test_pages_link_to_the_next_cursor(ivr):
+    add_responses(ivr, 5)
+    client = ivr.app.test_client()
+    first = client.get('/responses?limit=2')
+    assert [r['id'] for r in first.json] == [1, 2]
+    assert first.headers['X-Next-Cursor'] == '2'
+    second = client.get('/responses?limit=2&cursor=2')
+    assert [r['id'] for r in second.json] == [3, 4]
+    assert 'X-Next-Cursor' not in client.get('/responses?limit=2&cursor=4').headers
+
+
+def test_ndjson_streams_every_match(ivr):
+    add_responses(ivr, 3)
+    response = ivr.app.test_client().get('/responses?format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['id'] for line in response.data.splitlines()] == [1, 2, 3]
+
+
+def test_malformed_arguments_are_rejected(ivr):
+    client = ivr.app.test_client()
+    for query in ('cursor=abc', 'cursor=-5', 'limit=abc', 'limit=0', 'since=yesterday'):
+        assert client.get('/responses?' + query).status_code == 400, query
+
+
+def test_etag_changes_when_a_response_is_added(ivr):
+    add_responses(ivr, 1)
+    client = ivr.app.test_client()
+    etag = client.get('/responses').headers['ETag']
+    assert client.get('/responses', headers={'If-None-Match': etag}).status_code == 304
+    # Validators are per query, so another page never answers 304 for this one
+    assert client.get('/responses?limit=5', headers={'If-None-Match': etag}).status_code == 200
+    add_responses(ivr, 1)
+    assert client.get('/responses', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_json_and_ndjson_have_different_etags(ivr):
+    add_responses(ivr, 1)
+    client = ivr.app.test_client()
+    response = client.get('/responses')
+    assert response.headers['Vary'] == 'Accept'
+    headers = {'If-None-Match': response.headers['ETag'], 'Accept': 'application/x-ndjson'}
+    ndjson = client.get('/responses', headers=headers)
+    assert ndjson.status_code == 200 and ndjson.mimetype == 'application/x-ndjson'
+    assert ndjson.headers['Vary'] == 'Accept'
+
+
+def test_if_modified_since_alone_never_gives_a_stale_304(ivr):
+    add_responses(ivr, 1)
+    client = ivr.app.test_client()
+    assert 'Last-Modified' not in client.get('/responses').headers
+    add_responses(ivr, 1)
+    response = client.get('/responses', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert response.status_code == 200 and len(response.json) == 2
+
+
+def test_pastor_message_etag(ivr):
+    client = ivr.app.test_client()
+    etag = client.get('/pastor-message').headers['ETag']
+    assert client.get('/pastor-message', headers={'If-None-Match': etag}).status_code == 304
+    ivr.store.set_pastor_message('https://m/1.mp3')
+    assert client.get('/pastor-message', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_pastor_message_etag_changes_once_the_recording_is_cached(ivr):
+    ivr.store.set_pastor_message('https://m/1.mp3')
+    client = ivr.app.test_client()
+    etag = client.get('/pastor-message').headers['ETag']
+    ivr.store.set_pastor_media('https://m/1.mp3', 'a' * 64)
+    response = client.get('/pastor-message', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.json['media_id'] == 'a' * 64
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from store import MemoryStore, ResponseStore, SQLiteStore
+
+
+def add(store, caller, day):
+    store.add_responses([{'name_recording': None, 'response_recording': 'https://r/{}'.format(day),
+                          'caller': caller, 'timestamp': '2024-01-{:02d}T12:00:00'.format(day)}])
+
+
+def test_cursor_pages_through_every_response_once(store):
+    for day in range(1, 8):
+        add(store, '+1' if day % 2 else '+2', day)
+    seen, after_id = [], None
+    while True:
+        page = store.list_responses(after_id=after_id, limit=3)
+        seen.extend(record['id'] for record in page)
+        if len(page) < 3:
+            break
+        after_id = page[-1]['id']
+    assert seen == list(range(1, 8))
+
+
+def test_filters_combine_with_the_cursor(store):
+    for day in range(1, 8):
+        add(store, '+1' if day % 2 else '+2', day)
+    page = store.list_responses(caller='+1', since='2024-01-02', until='2024-01-07', limit=10)
+    assert [record['id'] for record in page] == [3, 5]
+    assert [record['id'] for record in store.list_responses(caller='+1', after_id=3)] == [5, 7]
+    assert store.latest_response()['id'] == 7
+
+
+def test_saving_the_same_pastor_message_twice_keeps_one(store):
+    store.set_pastor_message('https://m/1.mp3', timestamp='2024-01-01T00:00:00')
+    store.set_pastor_message('https://m/1.mp3', timestamp='2024-01-02T00:00:00')
+    assert store.get_pastor_message()['timestamp'] == '2024-01-01T00:00:00'
+    store.set_pastor_media('https://m/1.mp3', 'abc')
+    store.set_pastor_message('https://m/2.mp3')
+    store.set_pastor_media('https://m/1.mp3', 'stale')
+    message = store.get_pastor_message()
+    assert (message['url'], message['media_id']) == ('https://m/2.mp3', None)
+
+
+def test_recording_callbacks_are_upserted(store):
+    recording = {'recording_sid': 'RE1', 'call_sid': 'CA1', 'status': 'in-progress', 'url': None,
+                 'duration': None, 'updated_at': '2024-01-01T00:00:00'}
+    store.save_recordings([recording, dict(recording, status='completed', url='https://r/1', duration=7)])
+    if isinstance(store, MemoryStore):
+        assert store._recordings['RE1']['status'] == 'completed'
+    else:
+        row = store._connect().execute('SELECT status, duration FROM recordings').fetchall()
+        assert [tuple(r) for r in row] == [('completed', 7)]
+
+
+def test_a_forked_worker_opens_its_own_connection(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'ivr.db'))
+    parent_conn = store._connect()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = store._connect() is not parent_conn
+            store.add_response(None, 'https://r/child', '+1')
+        except BaseException:
+            ok = False
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert store._connect() is parent_conn
+    assert [r['response_recording'] for r in store.list_responses()] == ['https://r/child']
+
+
+def test_the_store_interface_is_abstract():
+    with pytest.raises(TypeError):
+        ResponseStore()
@@ -0,0 +1,47 @@
+from xml.etree import ElementTree
+
+import pytest
+from twilio.twiml.voice_response import VoiceResponse
+
+from twiml import Template
+
+
+def build(name, url):
+    response = VoiceResponse()
+    response.say('Hello {}'.format(name))
+    response.play(url)
+    return response
+
+
+def canonical(xml):
+    return ElementTree.tostring(ElementTree.fromstring(xml))
+
+
+def test_render_matches_the_twilio_library():
+    template = Template(build, 'name', 'url')
+    for name, url in [('Ann', 'https://m/1.mp3'), ('O\'Neil & "Sons" <x>', 'https://m/1.mp3?a=1&b=2')]:
+        assert canonical(template.render(name=name, url=url)) == canonical(str(build(name, url)))
+
+
+def test_values_cannot_inject_verbs():
+    body = Template(build, 'name', 'url').render(name='</Say><Hangup/><Say>', url='x')
+    assert b'<Hangup' not in body
+
+
+def test_cache_is_bounded_and_invalidated():
+    template = Template(build, 'name', 'url', cache_size=2)
+    for i in range(5):
+        template.render(name=str(i), url='u')
+    assert len(template._cache) <= 2
+    template.invalidate()
+    assert template._cache == {}
+
+
+def test_each_field_must_appear_once():
+    def twice(name):
+        response = VoiceResponse()
+        response.say(name)
+        response.say(name)
+        return response
+    with pytest.raises(ValueError):
+        Template(twice, 'name')
@@ -0,0 +1,71 @@
+"""Precompiled TwiML so webhooks return bytes instead of rebuilding VoiceResponse trees."""
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from metrics import REGISTRY
+
+HEADERS = {'Content-Type': 'text/xml'}
+
+_PLACEHOLDER = '__twiml_{}__'
+_XML_ENTITIES = {'"': '&quot;', "'": '&apos;'}
+
+# Building and serializing the VoiceResponse trees happens once, at import, for static bodies and
+# templates alike, so no request pays for it. What remains per request is a template cache miss:
+# 'build' is splicing the escaped values into the precompiled text and 'serialize' is encoding it.
+TWIML_SECONDS = REGISTRY.histogram('ivr_twiml_seconds',
+                                   'Time rendering a TwiML template on a cache miss: splicing values (build) '
+                                   'and encoding (serialize)', ('template', 'phase'))
+TWIML_CACHE = REGISTRY.counter('ivr_twiml_cache_total', 'Template renders served from or added to the cache',
+                               ('template', 'result'))
+
+
+def render_static(response):
+    return str(response).encode('utf-8')
+
+
+class Template:
+    """A response serialized once with placeholders; render() only splices in escaped values."""
+
+    def __init__(self, build, *fields, cache_size=64, name=None):
+        self.name = name or build.__name__
+        xml = str(build(**{field: _PLACEHOLDER.format(field) for field in fields}))
+        self._parts = []
+        for field in sorted(fields, key=lambda field: _find_once(xml, _PLACEHOLDER.format(field))):
+            before, xml = xml.split(_PLACEHOLDER.format(field))
+            self._parts.append((before, field))
+        self._tail = xml
+        self._cache = {}
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def render(self, **values):
+        key = tuple(sorted(values.items()))
+        body = self._cache.get(key)
+        if body is None:
+            start = time.perf_counter()
+            xml = ''.join(
+                before + escape(str(values[field]), _XML_ENTITIES) for before, field in self._parts
+            ) + self._tail
+            built = time.perf_counter()
+            body = xml.encode('utf-8')
+            TWIML_SECONDS.observe(built - start, self.name, 'build')
+            TWIML_SECONDS.observe(time.perf_counter() - built, self.name, 'serialize')
+            TWIML_CACHE.inc(self.name, 'miss')
+            with self._lock:
+                if len(self._cache) >= self._cache_size:
+                    self._cache.clear()
+                self._cache[key] = body
+        else:
+            TWIML_CACHE.inc(self.name, 'hit')
+        return body
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def _find_once(xml, placeholder):
+    if xml.count(placeholder) != 1:
+        raise ValueError('Placeholder {} must appear exactly once in the template'.format(placeholder))
+    return xml.index(placeholder)